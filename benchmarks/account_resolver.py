@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# benchmark of the PlayerAccount resolution during upload: queries and time
+# per replay with the old per-player loop and upload.resolve_accounts(),
+# against a throw away sqlite DB with many accounts
+#
+# example cmdline calls:
+# ./account_resolver.py
+# ./account_resolver.py -a 100000 -r 200 -p 32
+#
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from django_setup import setup_django
+
+def populate(num_accounts, num_accountless):
+    """
+    fill the DB with accounts, some of them from players without accountid
+    """
+    from srs.models import PlayerAccount, Player, Replay, ReplayFile
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+
+    batch = 5000
+    for start in range(1, num_accounts+1, batch):
+        PlayerAccount.objects.bulk_create([PlayerAccount(accountid=i, countrycode="DE", names="player%d" % i) for i in range(start, min(start+batch, num_accounts+1))])
+    PlayerAccount.objects.bulk_create([PlayerAccount(accountid=-i, countrycode="", names="lonely%d" % i) for i in range(1, num_accountless+1)])
+
+    # accountless players need a replay
+    user, _ = User.objects.get_or_create(username="benchmark")
+    rfile = ReplayFile.objects.create(filename="bench.sdf", path="/tmp", ori_filename="bench.sdf", download_count=0)
+    replay = Replay.objects.create(versionString="91.0", gameID="0"*32, unixTime=timezone.now(), wallclockTime="0:10:00",
+                                   autohostname="", gametype="Bench", startpostype=1, title="bench", short_text="bench",
+                                   long_text="", notcomplete=False, uploader=user, replayfile=rfile)
+    accounts = PlayerAccount.objects.filter(accountid__lt=0)
+    Player.objects.bulk_create([Player(account=pa, name=pa.names, rank=0, spectator=False, replay=replay) for pa in accounts])
+
+def make_players(num_players, num_accounts, num_accountless, new_id):
+    """
+    game_setup['player'] like dicts: mostly known accounts, a few new ones,
+    renamed players, single players and springie games
+    """
+    players = []
+    for i in range(num_players):
+        kind = random.random()
+        if kind < 0.70:
+            accid = random.randint(1, num_accounts)
+            v = {"accountid": accid, "name": "player%d" % accid}
+        elif kind < 0.80:
+            accid = random.randint(1, num_accounts)
+            v = {"accountid": accid, "name": "renamed%d_%d" % (accid, i)}
+        elif kind < 0.88:
+            v = {"accountid": new_id+i, "name": "newbie%d" % (new_id+i)}
+        elif kind < 0.93 and num_accountless:
+            # a previously accountless player shows up with an account
+            v = {"accountid": new_id+i, "name": "lonely%d" % random.randint(1, num_accountless)}
+        elif kind < 0.97:
+            v = {"name": "single%d_%d" % (new_id, i)}
+        else:
+            v = {"lobbyid": new_id+i, "name": "springie%d" % (new_id+i)}
+        v.update({"countrycode": "DE", "rank": 1, "spectator": 0})
+        players.append(v)
+    return players
+
+def legacy_resolve(players):
+    """
+    the per-player loop that upload._store_demofile_data() used before
+    """
+    from django.db.models import Min
+    from srs.models import PlayerAccount, Player
+
+    accounts = []
+    for v in players:
+        pac = Player.objects.none()
+        if v.has_key("accountid"):
+            pac = Player.objects.filter(name=v["name"], account__accountid__lt=0)
+        else:
+            min_acc_id = PlayerAccount.objects.aggregate(Min("accountid"))['accountid__min']
+            if not min_acc_id or min_acc_id > 0: min_acc_id = 0
+            v["accountid"] = min_acc_id-1
+        if v.has_key("lobbyid"):
+            v["accountid"] = v["lobbyid"]
+        pa, created = PlayerAccount.objects.get_or_create(accountid=v["accountid"], defaults={'accountid': v["accountid"], 'countrycode': v["countrycode"], 'names': v["name"]})
+        if not created:
+            if v["name"] not in pa.names.split(";"):
+                pa.names += ";"+v["name"]
+                pa.save()
+        if pa.accountid > 0:
+            for player in pac:
+                old_ac = player.account
+                player.account = pa
+                player.save()
+                old_ac.delete()
+        accounts.append(pa)
+    return accounts
+
+def run(resolver, replays, num_players, num_accounts, num_accountless):
+    """
+    resolve the players of some replays, each in a transaction that is
+    rolled back, so every resolver sees the same DB
+    returns (queries per replay, ms per replay)
+    """
+    from django.db import connection, transaction
+
+    random.seed(1)
+    queries = 0
+    elapsed = 0.0
+    for r in range(replays):
+        players = make_players(num_players, num_accounts, num_accountless, num_accounts+1+r*num_players)
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            connection.queries = []
+            start = time.time()
+            resolver(players)
+            elapsed += time.time()-start
+            queries += len(connection.queries)
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+    return float(queries)/replays, elapsed*1000/replays
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark PlayerAccount resolution during upload.")
+    parser.add_argument("-a", "--accounts", help="PlayerAccounts in the DB (default: 100000)", type=int, default=100000)
+    parser.add_argument("-l", "--accountless", help="accounts of players without accountid (default: 1000)", type=int, default=1000)
+    parser.add_argument("-r", "--replays", help="replays to resolve (default: 100)", type=int, default=100)
+    parser.add_argument("-p", "--players", help="players per replay (default: 16)", type=int, default=16)
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix="srs_bench_")
+    try:
+        setup_django(os.path.join(tmpdir, "srs.db"))
+        from django.db import connection
+        from srs import upload
+
+        connection.use_debug_cursor = True
+        start = time.time()
+        populate(args.accounts, args.accountless)
+        print "populated %d accounts in %.1fs" % (args.accounts+args.accountless, time.time()-start)
+
+        print "%-16s %14s %14s" % ("resolver", "queries/replay", "ms/replay")
+        for name, resolver in (("legacy", legacy_resolve), ("resolve_accounts", upload.resolve_accounts)):
+            queries, ms = run(resolver, args.replays, args.players, args.accounts, args.accountless)
+            print "%-16s %14.1f %14.2f" % (name, queries, ms)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# writes synthetic, but structurally valid spring demo files (.sdf/.sdfz)
+#
+# example cmdline call:
+# ./demofile_generator.py -p 16 -s 40 -a 2 --stream-size 32 8v8.sdf
+#
+
+import os
+import sys
+import gzip
+import random
+import struct
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "srs"))
+import parse_demo_file
+
+
+def make_script(players=16, spectators=0, allyteams=2, options=20):
+    """
+    create a start script like the ones autohosts write
+    """
+    script = "[game]\n{\n"
+    for at in range(allyteams):
+        script += "[allyteam%d]\n{\nnumallies=0;\nstartrectbottom=1;\nstartrectleft=%f;\nstartrectright=%f;\nstartrecttop=0;\n}\n" % (at, float(at)/allyteams, float(at+1)/allyteams)
+    script += "[mapoptions]\n{\n"
+    for opt in range(options/2):
+        script += "mapopt%d=%d;\n" % (opt, opt)
+    script += "}\n[modoptions]\n{\n"
+    for opt in range(options):
+        script += "modopt%d=%s;\n" % (opt, ["1", "0.25", "com", "some words"][opt%4])
+    script += "}\n"
+    for pl in range(players+spectators):
+        script += "[player%d]\n{\naccountid=%d;\ncountrycode=DE;\nname=Player%d;\nrank=%d;\nspectator=%d;\n" % (pl, 100000+pl, pl, pl%7, int(pl >= players))
+        if pl < players:
+            script += "team=%d;\n" % pl
+        script += "}\n"
+    script += "[restrict]\n{\n}\n"
+    for team in range(players):
+        script += "[team%d]\n{\nallyteam=%d;\nhandicap=0;\nrgbcolor=0.99 0.5 0.12;\nside=ARM;\nteamleader=%d;\n}\n" % (team, team%allyteams, team)
+    script += "autohostaccountid=210171;\nautohostname=[AH]Host;\ngametype=Balanced Annihilation V7.72;\nmapname=DeltaSiegeDry;\nstartpostype=2;\n}\n"
+    return script
+
+def make_demo_stream(size, seed=0):
+    """
+    create a demo stream of about size bytes: DemoStreamChunkHeaders each
+    followed by a packet of random type and length
+    """
+    rnd = random.Random(seed)
+    chunks = []
+    pos = 0
+    gametime = 0.0
+    payload = "".join(chr(rnd.randint(0, 255)) for _ in range(256))
+    while pos < size:
+        length = rnd.randint(2, 64)
+        gametime += 1.0/30
+        chunks.append(parse_demo_file.DEMOSTREAM_CHUNK_HEADER.pack(gametime, length)+chr(rnd.randint(1, 90))+payload[:length-1])
+        pos += parse_demo_file.DEMOSTREAM_CHUNK_HEADER.size+length
+    return "".join(chunks)
+
+def pack_stats(fields, values):
+    return struct.pack("<"+"".join(t for _, t in fields), *values)
+
+def make_demofile(players=16, spectators=0, allyteams=2, options=20, stream_size=1024*1024, game_time=1800, seed=0):
+    """
+    returns the content of a .sdf with the given sizes
+    """
+    script = make_script(players, spectators, allyteams, options)
+    stream = make_demo_stream(stream_size, seed)
+    winners = "".join(chr(at) for at in range(0, allyteams, 2))
+
+    player_stats = "".join(pack_stats(parse_demo_file.PLAYER_STATISTICS, [pl*10+i for i in range(len(parse_demo_file.PLAYER_STATISTICS))]) for pl in range(players+spectators))
+
+    stat_period = 16
+    periods = game_time/stat_period+1
+    team_stats = struct.pack("<%di" % players, *([periods]*players))
+    for team in range(players):
+        for period in range(periods):
+            team_stats += pack_stats(parse_demo_file.TEAM_STATISTICS, [period*stat_period*30]+[float(team+period)]*12+[period]*7)
+
+    rnd = random.Random(seed)
+    header = parse_demo_file.DEMOFILE_HEADER.pack(
+        parse_demo_file.DEMOFILE_MAGIC,         # magic
+        4,                                      # version
+        parse_demo_file.DEMOFILE_HEADER.size,   # headerSize
+        "0.82.7.1",                             # versionString
+        "".join(chr(rnd.randint(0, 255)) for _ in range(16)), # gameID
+        1340000000,                             # unixTime
+        len(script),                            # scriptSize
+        len(stream),                            # demoStreamSize
+        game_time,                              # gameTime
+        game_time+60,                           # wallclockTime
+        players+spectators,                     # numPlayers
+        len(player_stats),                      # playerStatSize
+        4*len(parse_demo_file.PLAYER_STATISTICS), # playerStatElemSize
+        players,                                # numTeams
+        len(team_stats),                        # teamStatSize
+        4*len(parse_demo_file.TEAM_STATISTICS), # teamStatElemSize
+        stat_period,                            # teamStatPeriod
+        len(winners))                           # winningAllyTeamsSize
+    return header+script+stream+winners+player_stats+team_stats
+
+def write_demofile(path, compress=False, **kwargs):
+    """
+    write a synthetic demo to path, gzip compressed if compress is True,
+    kwargs are passed to make_demofile()
+    """
+    data = make_demofile(**kwargs)
+    if compress:
+        demofile = gzip.open(path, "wb")
+    else:
+        demofile = open(path, "wb")
+    try:
+        demofile.write(data)
+    finally:
+        demofile.close()
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic spring demo file.")
+    parser.add_argument("-p", "--players", help="number of players (default: 16)", type=int, default=16)
+    parser.add_argument("-s", "--spectators", help="number of spectators (default: 0)", type=int, default=0)
+    parser.add_argument("-a", "--allyteams", help="number of ally teams (default: 2)", type=int, default=2)
+    parser.add_argument("-o", "--options", help="number of mod options, half as many map options (default: 20)", type=int, default=20)
+    parser.add_argument("--stream-size", help="size of the demo stream in MB (default: 1)", type=float, default=1)
+    parser.add_argument("--seed", help="random seed, changes the gameID (default: 0)", type=int, default=0)
+    parser.add_argument("-z", "--compress", help="write a gzip compressed demo (.sdfz)", action="store_true")
+    parser.add_argument("path", help="file to write")
+    args = parser.parse_args(argv)
+
+    write_demofile(args.path, args.compress, players=args.players, spectators=args.spectators, allyteams=args.allyteams, options=args.options, stream_size=int(args.stream_size*1024*1024), seed=args.seed)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
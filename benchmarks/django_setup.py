@@ -0,0 +1,30 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# bootstrap of the benchmarks that use the srs models: settings with a
+# throw away sqlite DB instead of the one configured in mydb.py
+#
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def setup_django(db_path):
+    """
+    use a sqlite DB at db_path instead of the one configured in mydb.py and
+    create the tables
+    """
+    mydb = types.ModuleType("mydb")
+    mydb.my_con = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': db_path, 'USER': '', 'PASSWORD': '', 'HOST': '', 'PORT': ''}
+    sys.modules["mydb"] = sys.modules["srs.mydb"] = mydb
+    os.environ["DJANGO_SETTINGS_MODULE"] = "srs.settings"
+    from django.core.management import call_command
+    call_command("syncdb", interactive=False, verbosity=0)
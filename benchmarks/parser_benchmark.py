@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# benchmark suite for Parse_demo_file: latency, read syscalls and peak memory
+# over a matrix of synthetic demo files
+#
+# example cmdline calls:
+# ./parser_benchmark.py -o before.json
+# ./parser_benchmark.py -o after.json -c before.json
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "srs"))
+import parse_demo_file
+from demofile_generator import write_demofile
+
+MB = 1024*1024
+
+# name, kwargs for make_demofile()
+SIZES = (
+    ("1v1", dict(players=2, spectators=2, allyteams=2, options=20, stream_size=1*MB)),
+    ("8v8", dict(players=16, spectators=10, allyteams=2, options=60, stream_size=8*MB)),
+    ("8v8 40 specs", dict(players=16, spectators=40, allyteams=2, options=60, stream_size=32*MB)),
+    ("16 FFA 100 specs", dict(players=16, spectators=100, allyteams=16, options=60, stream_size=64*MB, game_time=3*3600)),
+    )
+QUICK_SIZES = SIZES[:2]
+
+def op_parse(demofile):
+    demofile.parse()
+
+def op_metadata(demofile):
+    demofile.parse(winners=False)
+
+def op_stats(demofile):
+    demofile.parse_stats()
+
+def op_packets(demofile):
+    for _ in demofile.iter_packets():
+        pass
+
+OPERATIONS = (("parse", op_parse), ("metadata", op_metadata), ("stats", op_stats), ("packets", op_packets))
+
+
+def read_syscalls():
+    """
+    number of read syscalls of this process so far (Linux only, else None)
+    """
+    try:
+        with open("/proc/self/io") as io:
+            for line in io:
+                if line.startswith("syscr:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def measure(path, op, repeat, queue):
+    """
+    runs in a fresh process, so ru_maxrss is the peak of this case only
+    """
+    func = dict(OPERATIONS)[op]
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    syscalls = 0
+    for _ in range(repeat):
+        demofile = parse_demo_file.Parse_demo_file(path)
+        sc_start = read_syscalls()
+        start = time.time()
+        func(demofile)
+        times.append(time.time()-start)
+        if sc_start is not None:
+            syscalls += read_syscalls()-sc_start
+    times.sort()
+    queue.put({"best_ms": times[0]*1000,
+               "median_ms": times[len(times)/2]*1000,
+               "read_syscalls": syscalls/repeat if sc_start is not None else None,
+               "peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-base_rss})
+
+def run_case(path, op, repeat):
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=measure, args=(path, op, repeat, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+def compare(result, previous):
+    """
+    returns a string with the relative change of the median latency
+    """
+    for old in previous["cases"]:
+        if (old["size"], old["format"], old["op"]) == (result["size"], result["format"], result["op"]):
+            if old["median_ms"] > 0:
+                return "%+6.1f%%" % ((result["median_ms"]/old["median_ms"]-1)*100)
+    return "     -"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Parse_demo_file on synthetic demo files.")
+    parser.add_argument("-n", "--repeat", help="runs per measurement (default: 5)", type=int, default=5)
+    parser.add_argument("-q", "--quick", help="only the small sizes", action="store_true")
+    parser.add_argument("-o", "--output", help="save results as JSON to this file")
+    parser.add_argument("-c", "--compare", help="compare with results saved by a previous run")
+    args = parser.parse_args(argv)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as prev:
+            previous = json.load(prev)
+
+    results = {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "python": platform.python_version(),
+               "machine": platform.platform(),
+               "parser_version": parse_demo_file.PARSER_VERSION,
+               "cases": []}
+    tmpdir = tempfile.mkdtemp(prefix="srs_bench_")
+    try:
+        print "%-18s %-5s %-9s %10s %10s %8s %10s %8s" % ("size", "fmt", "op", "best ms", "median ms", "syscr", "peak KB", "change")
+        for size, kwargs in (QUICK_SIZES if args.quick else SIZES):
+            for fmt in ("sdf", "sdfz"):
+                path = write_demofile(os.path.join(tmpdir, "%s.%s" % (size.replace(" ", "_"), fmt)), fmt == "sdfz", **kwargs)
+                for op, _ in OPERATIONS:
+                    result = run_case(path, op, args.repeat)
+                    result.update({"size": size, "format": fmt, "op": op, "file_bytes": os.path.getsize(path)})
+                    results["cases"].append(result)
+                    print "%-18s %-5s %-9s %10.2f %10.2f %8s %10d %8s" % (size, fmt, op, result["best_ms"], result["median_ms"], result["read_syscalls"], result["peak_kb"], compare(result, previous) if previous else "")
+                os.remove(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.output:
+        with open(args.output, "wb") as out:
+            json.dump(results, out, indent=1)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# benchmark of the replay search: time per query of the old icontains
+# OR-join (count and all results) and of search.SearchResults (count and
+# first page), against a throw away sqlite DB with many replays
+#
+# example cmdline calls:
+# ./replay_search.py
+# ./replay_search.py -r 50000 -q 50
+#
+# with the default options (20000 replays, sqlite) the old query took about
+# 304ms per query, the index about 81ms
+#
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from django_setup import setup_django
+
+MAPS = ["Comet Catcher Redux", "DeltaSiegeDry", "Tabula v4", "Altair Crossing", "Red Comet", "Folsom Dam", "Throne v1", "SmallDivide", "Titan v2", "Tangerine"]
+GAMES = ["Balanced Annihilation V7.72", "Zero-K v1.0.3", "Spring: 1944 v2.0", "Evolution RTS v1.1", "NOTA 1.72"]
+TAGS = ["1v1", "2v2", "3v3", "FFA", "tournament", "newbie", "epic", "comeback", "nuke", "rush"]
+WORDS = ["great", "game", "close", "fight", "early", "late", "push", "defense", "air", "tanks", "lost", "won", "funny", "fail", "strategy"]
+
+def populate(num_replays, num_accounts, players_per_replay):
+    """
+    fill the DB with replays, their tags, maps and players
+    """
+    from srs.models import PlayerAccount, Player, Replay, ReplayFile, Map, Tag
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+
+    random.seed(1)
+    users = [User.objects.create(username="uploader%d" % i) for i in range(20)]
+    maps = [Map.objects.create(name=name, height=16, width=16) for name in MAPS]
+    # syncdb already created some of them from srs/sql/tag.sql
+    tags = [Tag.objects.get_or_create(name=name)[0] for name in TAGS]
+    rfile = ReplayFile.objects.create(filename="bench.sdf", path="/tmp", ori_filename="bench.sdf", download_count=0)
+    PlayerAccount.objects.bulk_create([PlayerAccount(accountid=i, countrycode="DE", names="player%d;alias%d" % (i, i)) for i in range(1, num_accounts+1)])
+    accounts = list(PlayerAccount.objects.order_by("pk").values_list("pk", "names"))
+
+    batch = 1000
+    now = timezone.now()
+    for start in range(0, num_replays, batch):
+        replays = []
+        for i in range(start, min(start+batch, num_replays)):
+            short = " ".join(random.sample(WORDS, 3))
+            replays.append(Replay(versionString="91.0", gameID="%032x" % i, unixTime=now, wallclockTime="0:20:00",
+                                  autohostname="", gametype=random.choice(GAMES), startpostype=1, title="%s %s" % (random.choice(TAGS), short),
+                                  short_text=short, long_text=" ".join(random.sample(WORDS, 8)), notcomplete=False,
+                                  uploader=random.choice(users), replayfile=rfile, map_info=random.choice(maps)))
+        Replay.objects.bulk_create(replays)
+        pks = list(Replay.objects.filter(gameID__in=[r.gameID for r in replays]).values_list("pk", flat=True))
+        Replay.tags.through.objects.bulk_create([Replay.tags.through(replay_id=pk, tag=tag) for pk in pks for tag in random.sample(tags, 2)])
+        players = []
+        for pk in pks:
+            for account_pk, names in random.sample(accounts, players_per_replay):
+                players.append(Player(account_id=account_pk, name=names.split(";")[0], rank=1, spectator=False, replay_id=pk))
+        Player.objects.bulk_create(players)
+
+def make_queries(num_queries, num_accounts):
+    """
+    single words of the different fields and some combinations
+    """
+    random.seed(2)
+    queries = []
+    for i in range(num_queries):
+        kind = i % 5
+        if kind == 0:
+            queries.append(random.choice(MAPS).split()[0])
+        elif kind == 1:
+            queries.append("player%d" % random.randint(1, num_accounts))
+        elif kind == 2:
+            queries.append(random.choice(TAGS))
+        elif kind == 3:
+            queries.append("%s %s" % (random.choice(WORDS), random.choice(GAMES).split()[0]))
+        else:
+            queries.append("nomatch%d" % i)
+    return queries
+
+def legacy_search(query):
+    """
+    the query of views.search() before the index, its count and all results
+    """
+    from django.db.models import Q
+    from django.contrib.auth.models import User
+    from srs.models import Replay
+
+    users = User.objects.filter(username__icontains=query)
+    replays = Replay.objects.filter(Q(gametype__icontains=query)|
+                                    Q(title__icontains=query)|
+                                    Q(short_text__icontains=query)|
+                                    Q(long_text__icontains=query)|
+                                    Q(map_info__name__icontains=query)|
+                                    Q(tags__name__icontains=query)|
+                                    Q(uploader__in=users)|
+                                    Q(player__account__names__icontains=query)).distinct()
+    count = replays.count()
+    for replay in replays:
+        replay.get_absolute_url()
+    return count
+
+def index_search(query):
+    """
+    count and the first page of 50, as views.search() renders them
+    """
+    from srs import search
+
+    results = search.SearchResults(query)
+    count = results.count()
+    for replay in results[:50]:
+        replay.get_absolute_url()
+    return count
+
+def run(searcher, queries):
+    """
+    returns (ms per query, max ms, total results)
+    """
+    times = []
+    results = 0
+    for query in queries:
+        start = time.time()
+        results += searcher(query)
+        times.append((time.time()-start)*1000)
+    return sum(times)/len(times), max(times), results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the replay search.")
+    parser.add_argument("-r", "--replays", help="replays in the DB (default: 20000)", type=int, default=20000)
+    parser.add_argument("-a", "--accounts", help="PlayerAccounts in the DB (default: 5000)", type=int, default=5000)
+    parser.add_argument("-p", "--players", help="players per replay (default: 8)", type=int, default=8)
+    parser.add_argument("-q", "--queries", help="queries to run (default: 25)", type=int, default=25)
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix="srs_bench_")
+    try:
+        setup_django(os.path.join(tmpdir, "srs.db"))
+        from srs import search
+
+        start = time.time()
+        populate(args.replays, args.accounts, args.players)
+        print "populated %d replays in %.1fs" % (args.replays, time.time()-start)
+        start = time.time()
+        search.rebuild_index()
+        print "indexed %d replays in %.1fs" % (args.replays, time.time()-start)
+
+        queries = make_queries(args.queries, args.accounts)
+        print "%-10s %12s %12s %10s" % ("search", "ms/query", "max ms", "results")
+        for name, searcher in (("legacy", legacy_search), ("index", index_search)):
+            ms, max_ms, results = run(searcher, queries)
+            print "%-10s %12.1f %12.1f %10d" % (name, ms, max_ms, results)
+        print "(results differ: the index matches whole words and word prefixes, the old query any substring)"
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# micro-benchmark: start script tokenizer (parse_demo_file.parse_script())
+# against the old regex + split implementation
+#
+# example cmdline call:
+# ./script_parser.py -n 2000
+#
+
+import os
+import re
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "srs"))
+import parse_demo_file
+from demofile_generator import make_script
+
+
+def legacy_make_numeric(val):
+    if val.isdigit():
+        return int(val)
+    else:
+        try:
+            return float(val)
+        except ValueError, TypeError:
+            pass
+    return val
+
+def legacy_parse_script(script):
+    """
+    the regex + split start script parser parse_demo_file used before
+    parse_script()
+    """
+    game_setup = {
+        'allyteam': {},
+        'mapoptions': {},
+        'modoptions': {},
+        'player': {},
+        'restrict': {},
+        'team': {},
+        'host': {}
+        }
+
+    game = re.match('^\[game\]\n\{(?P<data>.*)\}\n', script, re.DOTALL).groupdict()
+    section_iter = re.finditer('\[(?P<name>.*?)\]\n\{(?P<data>.*?)\}\n', game['data'], re.DOTALL)
+
+    while True:
+        try:
+            section_ = section_iter.next()
+            section = section_.groupdict()
+            if section and section['data'].strip():
+                for sec in ["allyteam", "player", "team"]:
+                    if section['name'].startswith(sec):
+                        subsec = section['name'].split(sec)[1]
+                        if not subsec in game_setup[sec]:
+                            game_setup[sec][subsec] = {}
+                        for data in section['data'].strip().split(";\n"):
+                            if data.strip():
+                                nam, val = data.split('=', 1)
+                                if nam:
+                                    if val:
+                                        if val[-1] == ";": val = val[:-1]
+                                        val = legacy_make_numeric(val.strip())
+                                    game_setup[sec][subsec][nam] = val
+                for sec in ["mapoptions", "modoptions", "restrict"]:
+                    if section['name'] == sec:
+                        for data in section['data'].strip().split(";\n"):
+                            if data.strip():
+                                nam, val = data.split('=', 1)
+                                if val[-1] == ";": val = val[:-1]
+                                val = legacy_make_numeric(val.strip())
+                                game_setup[sec][nam] = val
+        except StopIteration:
+            break
+
+    for data in game['data'].split("}")[-1:][0].strip().split(";"):
+        if data:
+            game_setup['host'][data.split("=", 1)[0].strip()] = data.split("=", 1)[1].strip()
+    for k,v in game_setup['host'].items():
+        game_setup['host'][k] = legacy_make_numeric(v)
+    return game_setup
+
+
+SCENARIOS = (
+    ("1v1", dict(players=2, spectators=2, allyteams=2, options=20)),
+    ("8v8", dict(players=16, spectators=4, allyteams=2, options=60)),
+    ("8v8, 40 specs", dict(players=16, spectators=40, allyteams=2, options=60)),
+    ("16 FFA, 100 specs", dict(players=16, spectators=100, allyteams=16, options=60)),
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the start script tokenizer with the old regex based parser.")
+    parser.add_argument("-n", "--number", help="parses per measurement (default: 1000)", type=int, default=1000)
+    parser.add_argument("-r", "--repeat", help="measurements per scenario, the best is reported (default: 3)", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print "%-20s %8s %12s %12s %8s" % ("scenario", "bytes", "old (us)", "new (us)", "speedup")
+    for name, kwargs in SCENARIOS:
+        script = make_script(**kwargs)
+        if legacy_parse_script(script) != parse_demo_file.parse_script(script):
+            print "%-20s results differ!" % name
+            return 1
+        old = min(timeit.repeat(lambda: legacy_parse_script(script), number=args.number, repeat=args.repeat))
+        new = min(timeit.repeat(lambda: parse_demo_file.parse_script(script), number=args.number, repeat=args.repeat))
+        print "%-20s %8d %12.1f %12.1f %7.2fx" % (name, len(script), old/args.number*1e6, new/args.number*1e6, old/new)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,14 +13,21 @@ from django.contrib import admin
 admin.site.register(Tag)
 admin.site.register(Map)
 admin.site.register(MapImg)
+admin.site.register(MapLookup)
 admin.site.register(Replay)
 admin.site.register(Allyteam)
 admin.site.register(PlayerAccount)
+admin.site.register(PlayerAlias)
+admin.site.register(AccountIdSequence)
 admin.site.register(Player)
 admin.site.register(Team)
 admin.site.register(MapOption)
 admin.site.register(ModOption)
 admin.site.register(ReplayFile)
 admin.site.register(NewsItem)
+admin.site.register(IngestJob)
+admin.site.register(IngestTiming)
+admin.site.register(UploadSession)
+admin.site.register(SearchTerm)
 
 admin.site.register(UserProfile)
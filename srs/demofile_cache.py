@@ -0,0 +1,179 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# on-disk cache for the results of Parse_demo_file.parse(), keyed by the
+# SHA1 of the demo files content and PARSER_VERSION
+#
+
+import os
+import zlib
+import fcntl
+import hashlib
+import logging
+import cPickle
+from tempfile import mkstemp
+
+import settings
+import parse_demo_file
+
+logger = logging.getLogger(__package__)
+
+# total size of the entries, shared by all processes using the cache
+SIZE_FILE = ".size"
+# eviction removes entries until the cache is below this part of max_size
+EVICT_TO = 0.9
+
+
+def hash_demofile(filename=None, data=None):
+    """
+    SHA1 hexdigest of a files content or of data
+    """
+    sha1 = hashlib.sha1()
+    if data is not None:
+        sha1.update(data)
+    else:
+        with open(filename, "rb") as demofile:
+            for chunk in iter(lambda: demofile.read(1024*1024), ""):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+class DemofileCache():
+    """
+    stores header, game_setup and winningAllyTeams of parsed demos as
+    zlib compressed pickles in path/<sha1[:2]>/<sha1>-<PARSER_VERSION>
+    The access time of an entry is kept in its mtime, when the cache grows
+    beyond max_size bytes the least recently used entries are removed. The
+    size is tracked in SIZE_FILE, so the cache is only scanned when it is
+    full (or the size is unknown), not per instance.
+    """
+    def __init__(self, path=settings.DEMOFILE_CACHE_PATH, max_size=settings.DEMOFILE_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def entry_path(self, digest):
+        return os.path.join(self.path, digest[:2], "%s-%d" % (digest, parse_demo_file.PARSER_VERSION))
+
+    def get(self, digest):
+        """
+        returns the cached dict or None
+        """
+        path = self.entry_path(digest)
+        try:
+            with open(path, "rb") as entry:
+                data = cPickle.loads(zlib.decompress(entry.read()))
+            os.utime(path, None)
+            return data
+        except (IOError, OSError):
+            return None
+        except Exception, e:
+            logger.error("Removing broken cache entry '%s': %s", path, e)
+            self.remove(path)
+            return None
+
+    def put(self, digest, data):
+        """
+        store data (a dict) atomically
+        - may raise IOError/OSError when writing the file
+        """
+        path = self.entry_path(digest)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        blob = zlib.compress(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+        (fd, tmp_path) = mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            os.write(fd, blob)
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, path)
+        size = self.update_size(len(blob))
+        if size is None or size > self.max_size:
+            self.evict()
+
+    def update_size(self, added=0, size=None):
+        """
+        add bytes to the size in SIZE_FILE (or set it to size), under an
+        exclusive lock
+        returns the new size, None if it isn't known yet
+        - may raise IOError/OSError
+        """
+        fd = os.open(os.path.join(self.path, SIZE_FILE), os.O_RDWR|os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if size is None:
+                try:
+                    size = int(os.read(fd, 32))+added
+                except ValueError:
+                    return None
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(size))
+            return size
+        finally:
+            os.close(fd)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        remove least recently used entries until the cache is below
+        EVICT_TO*max_size and store the size in SIZE_FILE
+        """
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename == SIZE_FILE:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total > self.max_size:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size*EVICT_TO:
+                    break
+                self.remove(path)
+                total -= size
+            logger.debug("evicted cache entries, %d bytes left", total)
+        self.update_size(size=total)
+
+    def parse(self, filename=None, data=None, digest=None):
+        """
+        returns a Parse_demo_file object for filename (or data) with header,
+        game_setup and winningAllyTeams populated - from the cache if the
+        content was parsed before, else it is parsed and the result cached
+        digest: SHA1 hexdigest of the content if already known (saves
+                reading it again)
+        - may raise IOError when opening a file to read
+        - may raise Exception when file is not a spring demofile
+        """
+        if not digest:
+            digest = hash_demofile(filename, data)
+        demofile = parse_demo_file.Parse_demo_file(filename, data)
+        cached = self.get(digest)
+        if cached:
+            demofile.header = cached["header"]
+            demofile.game_setup = cached["game_setup"]
+            demofile.winningAllyTeams = cached["winningAllyTeams"]
+        else:
+            demofile.parse()
+            try:
+                self.put(digest, {"header": demofile.header, "game_setup": demofile.game_setup, "winningAllyTeams": demofile.winningAllyTeams})
+            except (IOError, OSError), e:
+                logger.error("Could not cache parsed demofile: %s", e)
+        demofile.sha1 = digest
+        return demofile
@@ -0,0 +1,172 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# background part of the replay ingestion: uploads store the replay and an
+# IngestJob, the workers started by "manage.py ingest_worker" fetch the map
+# infos and render the map images
+#
+
+import time
+import logging
+import datetime
+import threading
+
+from django.db import connection
+from django.utils import timezone
+
+from models import *
+import settings
+import spring_maps
+import timing
+import sidebar
+import replay_pages
+
+logger = logging.getLogger(__package__)
+
+
+def get_map_info(mapname, timer=None):
+    """
+    get / create map infos
+    - may raise spring_maps.MapNotFound
+    """
+    return spring_maps.MapInfoResolver().resolve(mapname, timer)
+
+def get_map_img(replay):
+    """
+    get / create the map picture with start positions / boxes
+    """
+    if replay.startpostype == 1:
+        # fixed start positions before game
+        try:
+            map_img = MapImg.objects.get(map_info = replay.map_info, startpostype=1)
+            logger.debug("replay pk=%d using existing map_img.pk=%d", replay.pk, map_img.pk)
+        except MapImg.DoesNotExist:
+            mapfile = spring_maps.create_map_with_positions(replay.map_info)
+            map_img = MapImg.objects.create(filename=mapfile, startpostype=1, map_info=replay.map_info)
+            logger.debug("replay pk=%d created new map_img.pk=%d", replay.pk, map_img.pk)
+    else:
+        # start boxes
+        mapfile = spring_maps.create_map_with_boxes(replay)
+        map_img = MapImg.objects.create(filename=mapfile, startpostype=2, map_info=replay.map_info)
+        logger.debug("replay pk=%d created new map_img.pk=%d", replay.pk, map_img.pk)
+    return map_img
+
+def set_progress(job, progress):
+    job.progress = progress
+    IngestJob.objects.filter(pk=job.pk).update(progress=progress, updated=timezone.now())
+
+def process_job(job, retry=True):
+    """
+    run all stages of an IngestJob, on failure it is queued again until
+    settings.INGEST_MAX_ATTEMPTS is reached if retry is set (jobs run in the
+    upload request are not, there may be no worker), else it fails. Maps
+    that were not found fail the job at once.
+    """
+    replay = job.replay
+    job.attempts += 1
+    timer = timing.StageTimer()
+    if job.attempts == 1:
+        timer.add("queue", (timezone.now()-job.created).total_seconds())
+    try:
+        if not replay.map_info:
+            set_progress(job, "fetching map infos")
+            replay.map_info = get_map_info(job.mapname, timer)
+            Replay.objects.filter(pk=replay.pk).update(map_info=replay.map_info)
+            sidebar.invalidate("replay pk=%d got its map" % replay.pk)
+        set_progress(job, "rendering map image")
+        with timer.stage("map_img"):
+            replay.map_img = get_map_img(replay)
+        Replay.objects.filter(pk=replay.pk).update(map_img=replay.map_img)
+        job.status = IngestJob.DONE
+        job.progress = "done"
+        job.error = ""
+        logger.info("IngestJob pk=%d replay pk=%d gameID=%s done", job.pk, replay.pk, replay.gameID)
+    except spring_maps.MapNotFound, e:
+        # retrying before MAP_INFO_NEGATIVE_TTL would only hit the cached
+        # result, set it to queued in the admin to try again
+        logger.info("IngestJob pk=%d replay pk=%d gameID=%s failed: %s", job.pk, replay.pk, replay.gameID, e)
+        job.error = unicode(e)[:1024]
+        job.status = IngestJob.FAILED
+        job.progress = "map not found"
+    except Exception, e:
+        logger.exception("IngestJob pk=%d replay pk=%d gameID=%s attempt %d failed: %s", job.pk, replay.pk, replay.gameID, job.attempts, e)
+        job.error = unicode(e)[:1024]
+        if retry and job.attempts < settings.INGEST_MAX_ATTEMPTS:
+            job.status = IngestJob.QUEUED
+            job.progress = "waiting for retry"
+        else:
+            job.status = IngestJob.FAILED
+            job.progress = "failed"
+    job.save()
+    replay_pages.invalidate(replay.gameID)
+    timer.total("ingest")
+    timer.save(replay)
+    return job
+
+def claim_job():
+    """
+    returns the oldest queued IngestJob after marking it as running, or None
+    if there is none. Safe with concurrent workers.
+    """
+    for pk in IngestJob.objects.filter(status=IngestJob.QUEUED).order_by("pk").values_list("pk", flat=True)[:10]:
+        if IngestJob.objects.filter(pk=pk, status=IngestJob.QUEUED).update(status=IngestJob.RUNNING, progress="started", updated=timezone.now()):
+            return IngestJob.objects.select_related("replay", "replay__map_info").get(pk=pk)
+    return None
+
+def requeue_abandoned_jobs():
+    """
+    queue jobs again that have been running longer than
+    settings.INGEST_JOB_TIMEOUT (their worker died)
+    """
+    limit = timezone.now()-datetime.timedelta(seconds=settings.INGEST_JOB_TIMEOUT)
+    num = IngestJob.objects.filter(status=IngestJob.RUNNING, updated__lt=limit).update(status=IngestJob.QUEUED, progress="waiting for retry", updated=timezone.now())
+    if num:
+        logger.info("queued %d abandoned IngestJobs again", num)
+    return num
+
+def work(stop, poll_interval=settings.INGEST_POLL_INTERVAL):
+    """
+    worker loop: process jobs until the threading.Event stop is set
+    """
+    while not stop.is_set():
+        try:
+            job = claim_job()
+            if job:
+                process_job(job)
+            else:
+                stop.wait(poll_interval)
+        except Exception, e:
+            logger.exception("IngestJob worker: %s", e)
+            stop.wait(poll_interval)
+        finally:
+            # make other workers changes visible (repeatable read) and
+            # don't keep a connection per idle thread
+            connection.close()
+
+def run_workers(workers=settings.INGEST_WORKERS, poll_interval=settings.INGEST_POLL_INTERVAL):
+    """
+    run a pool of worker threads until interrupted
+    """
+    requeue_abandoned_jobs()
+    stop = threading.Event()
+    threads = [threading.Thread(target=work, args=(stop, poll_interval), name="ingest-%d" % num) for num in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    logger.info("started %d IngestJob workers", workers)
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(poll_interval)
+            requeue_abandoned_jobs()
+    except KeyboardInterrupt:
+        logger.info("stopping IngestJob workers")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,196 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import logging
+import multiprocessing
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from srs.models import Replay, ReplayFile
+from srs import upload, demofile_cache, parse_demo_file, storage
+
+logger = logging.getLogger("srs")
+
+STAGES = ("parse", "dedup", "copy", "store")
+
+
+def parse_demofile(path):
+    """
+    worker of the process pool, returns (path, demofile, seconds, error)
+    """
+    start = time.time()
+    try:
+        demofile = demofile_cache.DemofileCache().parse(path)
+        return (path, demofile, time.time()-start, None)
+    except Exception, e:
+        return (path, None, time.time()-start, "%s: %s" % (e.__class__.__name__, e))
+
+class Checkpoint(object):
+    """
+    number of files (of the sorted list of found files) that are done, kept
+    in a JSON file together with the last path as sanity check
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, paths):
+        """
+        returns the number of files of paths that are already done
+        """
+        try:
+            with open(self.path) as cp:
+                state = json.load(cp)
+        except (IOError, ValueError):
+            return 0
+        done = state["done"]
+        if 0 < done <= len(paths) and paths[done-1] == state["last"]:
+            return done
+        logger.info("Checkpoint '%s' does not match the files to import, starting from the beginning.", self.path)
+        return 0
+
+    def save(self, paths, done):
+        tmp = self.path+".tmp"
+        with open(tmp, "wb") as cp:
+            json.dump({"done": done, "last": paths[done-1]}, cp)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Command(BaseCommand):
+    args = "<path> [path ...]"
+    help = "Import the demofiles in directories (recursively) or globs. Files are parsed in a process pool and stored in batches. An interrupted import continues from its checkpoint."
+    option_list = BaseCommand.option_list + (
+        make_option("-o", "--owner", dest="owner",
+                    help="username of the uploader to store the replays under (required)"),
+        make_option("-t", "--tags", dest="tags", default="",
+                    help="comma separated tags for all replays"),
+        make_option("-p", "--processes", type="int", dest="processes", default=multiprocessing.cpu_count(),
+                    help="number of parser processes (default: number of CPUs)"),
+        make_option("-b", "--batch-size", type="int", dest="batch_size", default=100,
+                    help="replays stored per transaction (default: 100)"),
+        make_option("-c", "--checkpoint", dest="checkpoint", default=os.path.join(settings.LOG_PATH, "import_replays.checkpoint"),
+                    help="file to save the progress in (default: import_replays.checkpoint in settings.LOG_PATH)"),
+        )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Please name at least one directory or file to import.")
+        try:
+            self.user = User.objects.get(username__iexact=options["owner"])
+        except User.DoesNotExist:
+            raise CommandError("Unknown owner '%s', please name an existing user with --owner." % options["owner"])
+        self.tags = options["tags"]
+        self.timings = dict((stage, 0.0) for stage in STAGES)
+        self.parse_cpu = 0.0 # sum of the time the parser processes spent
+        self.counts = {"imported": 0, "duplicates": 0, "errors": 0}
+
+        paths = sorted(parse_demo_file.find_demofiles(args))
+        checkpoint = Checkpoint(options["checkpoint"])
+        done = checkpoint.load(paths)
+        if done:
+            self.stdout.write("Resuming after %d of %d files.\n" % (done, len(paths)))
+
+        batch_size = max(options["batch_size"], 1)
+        pool = multiprocessing.Pool(max(options["processes"], 1))
+        start = time.time()
+        try:
+            # imap() keeps the order, so the checkpoint is a position in paths
+            results = pool.imap(parse_demofile, paths[done:], chunksize=4)
+            for batch_start in range(done, len(paths), batch_size):
+                batch = []
+                parse_start = time.time()
+                for _ in range(min(batch_size, len(paths)-batch_start)):
+                    batch.append(results.next())
+                self.timings["parse"] += time.time()-parse_start
+                self.import_batch(batch)
+                checkpoint.save(paths, batch_start+len(batch))
+                self.report(batch_start+len(batch)-done, len(paths)-done, time.time()-start)
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise CommandError("Interrupted, run the same command again to resume.")
+        except BaseException:
+            # join() needs a closed or terminated pool
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        checkpoint.remove()
+
+        duration = max(time.time()-start, 0.000001)
+        self.stdout.write("Imported %(imported)d replays, skipped %(duplicates)d duplicates and %(errors)d broken files" % self.counts)
+        self.stdout.write(" in %.1fs: %.1f replays/s\n" % (duration, self.counts["imported"]/duration))
+        self.stdout.write("Time per stage: %s (parser processes: %.1fs)\n" % (", ".join(["%s %.1fs" % (stage, self.timings[stage]) for stage in STAGES]), self.parse_cpu))
+
+    def import_batch(self, batch):
+        """
+        batch: list of parse_demofile() results
+        """
+        demofiles = []
+        for path, demofile, seconds, error in batch:
+            self.parse_cpu += seconds
+            if not error:
+                # one unsupported replay would fail the whole batch
+                try:
+                    upload.check_supported(demofile)
+                except Exception, e:
+                    error = str(e)
+            if error:
+                self.counts["errors"] += 1
+                logger.info("Import of '%s' failed: %s", path, error)
+            else:
+                demofiles.append((path, demofile))
+
+        # duplicates in the DB and in the batch
+        stage_start = time.time()
+        known = set(Replay.objects.filter(gameID__in=[d.header["gameID"] for _, d in demofiles]).values_list("gameID", flat=True))
+        new = []
+        for path, demofile in demofiles:
+            if demofile.header["gameID"] in known:
+                self.counts["duplicates"] += 1
+            else:
+                known.add(demofile.header["gameID"])
+                new.append((path, demofile))
+        self.timings["dedup"] += time.time()-stage_start
+
+        stage_start = time.time()
+        replay_storage = storage.ReplayStorage()
+        uploads = []
+        for path, demofile in new:
+            filename = os.path.basename(path)
+            uploads.append((demofile, replay_storage.store(path, demofile.sha1, copy=True), filename, os.path.splitext(filename)[0][:50], ""))
+        self.timings["copy"] += time.time()-stage_start
+
+        stage_start = time.time()
+        try:
+            upload.store_demofile_batch(uploads, self.tags, self.user)
+            self.counts["imported"] += len(uploads)
+        except Exception, e:
+            # find the broken one(s)
+            logger.info("Storing batch failed (%s), storing its replays one by one.", e)
+            for demofile, stored_name, filename, short, long_text in uploads:
+                try:
+                    upload.store_demofile_data(demofile, self.tags, stored_name, filename, short, long_text, self.user)
+                    self.counts["imported"] += 1
+                except Exception, e:
+                    self.counts["errors"] += 1
+                    logger.info("Import of '%s' failed: %s", filename, e)
+                    if not ReplayFile.objects.filter(filename=stored_name).exists():
+                        replay_storage.remove(stored_name)
+        self.timings["store"] += time.time()-stage_start
+
+    def report(self, done, total, elapsed):
+        self.stdout.write("%d/%d files, %.1f replays/s\n" % (done, total, self.counts["imported"]/max(elapsed, 0.000001)))
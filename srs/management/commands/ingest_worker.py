@@ -0,0 +1,27 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from srs import ingest
+
+
+class Command(NoArgsCommand):
+    help = "Process queued IngestJobs (map infos and images of uploaded replays) until interrupted."
+    option_list = NoArgsCommand.option_list + (
+        make_option("-w", "--workers", type="int", dest="workers", default=settings.INGEST_WORKERS,
+                    help="number of worker threads (default: settings.INGEST_WORKERS)"),
+        make_option("-p", "--poll-interval", type="float", dest="poll_interval", default=settings.INGEST_POLL_INTERVAL,
+                    help="seconds between checks for new jobs (default: settings.INGEST_POLL_INTERVAL)"),
+        )
+
+    def handle_noargs(self, **options):
+        ingest.run_workers(options["workers"], options["poll_interval"])
@@ -0,0 +1,58 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db.models import Q
+
+from srs.models import ReplayFile
+from srs import storage
+
+logger = logging.getLogger("srs")
+
+
+class Command(NoArgsCommand):
+    help = "Move replay files stored flat in MEDIA_ROOT into the content addressed ReplayStorage (compressing them if settings.REPLAY_STORAGE_COMPRESS). Can be interrupted and run again."
+    option_list = NoArgsCommand.option_list + (
+        make_option("-n", "--dry-run", action="store_true", dest="dry_run", default=False,
+                    help="only report what would be moved"),
+        make_option("-c", "--compress", action="store_true", dest="compress", default=False,
+                    help="also compress uncompressed files already in the storage"),
+        )
+
+    def handle_noargs(self, **options):
+        replay_storage = storage.ReplayStorage()
+        moved = missing = 0
+        # files in the storage have a name with directories
+        replayfiles = ReplayFile.objects.exclude(filename__contains="/")
+        if options["compress"]:
+            replayfiles = ReplayFile.objects.filter(Q(filename__endswith=".sdf") | ~Q(filename__contains="/"))
+        for rf in replayfiles.order_by("pk").iterator():
+            old_path = os.path.join(rf.path, rf.filename)
+            if not os.path.isfile(old_path):
+                missing += 1
+                logger.error("ReplayFile pk=%d: '%s' does not exist.", rf.pk, old_path)
+                continue
+            if options["dry_run"]:
+                moved += 1
+                continue
+            # copy, update the row, remove: an interruption leaves at worst
+            # the old file behind, never a row pointing nowhere
+            old = (rf.path, rf.filename)
+            rf.filename = replay_storage.store(old_path, copy=True)
+            rf.path = replay_storage.root
+            rf.save()
+            # identical uploads share a file in the storage
+            if not ReplayFile.objects.filter(path=old[0], filename=old[1]).exists():
+                os.remove(old_path)
+            moved += 1
+            logger.debug("ReplayFile pk=%d: moved '%s' to '%s'", rf.pk, old_path, rf.filename)
+        self.stdout.write("%s %d files, %d missing.\n" % ("Would move" if options["dry_run"] else "Moved", moved, missing))
@@ -0,0 +1,25 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from srs import search
+
+
+class Command(NoArgsCommand):
+    help = "Rebuild the search index of all replays, after adding the SearchTerm table or renaming players."
+    option_list = NoArgsCommand.option_list + (
+        make_option("-b", "--batch-size", type="int", dest="batch_size", default=500,
+                    help="replays indexed per transaction (default: 500)"),
+        )
+
+    def handle_noargs(self, **options):
+        num = search.rebuild_index(max(options["batch_size"], 1))
+        self.stdout.write("Indexed %d replays.\n" % num)
@@ -0,0 +1,18 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import NoArgsCommand
+
+from srs import upload
+
+
+class Command(NoArgsCommand):
+    help = "Recalculate the replay counters of the PlayerAccounts from the stored replays and rebuild the PlayerAliases (players list), after adding the columns or deleting replays."
+
+    def handle_noargs(self, **options):
+        upload.recount_games()
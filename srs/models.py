@@ -10,6 +10,7 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.comments import Comment
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 import settings
 
 class Tag(models.Model):
@@ -41,6 +42,24 @@ class Map(models.Model):
     def replays(self):
         return Replay.objects.filter(map_info__name=self.name).count()
 
+class MapLookup(models.Model):
+    """
+    state of fetching the infos of a map from springfiles, see
+    spring_maps.MapInfoResolver
+    """
+    FETCHING        = 0
+    FOUND           = 1
+    NOT_FOUND       = 2
+    ERROR           = 3
+    STATUS_CHOICES  = ((FETCHING, "fetching"), (FOUND, "found"), (NOT_FOUND, "not found"), (ERROR, "error"))
+
+    name            = models.CharField(max_length=128, unique=True)
+    status          = models.IntegerField(choices=STATUS_CHOICES, default=ERROR)
+    updated         = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        return self.name+" "+self.get_status_display()
+
 class MapImg(models.Model):
     filename        = models.CharField(max_length=128)
     startpostype    = models.IntegerField(blank=True, null = True, verbose_name='-1 means full image')
@@ -104,15 +123,48 @@ class PlayerAccount(models.Model):
     countrycode     = models.CharField(max_length=2)
     names           = models.CharField(max_length=2048, verbose_name="(re)names")
     aka             = models.ForeignKey("self", blank=True, null = True, verbose_name="other accounts")
+    # replays (as player or spectator), as spectator and as (non-spectating)
+    # player, maintained by the upload, see upload.add_replay_counts() and
+    # "manage.py recount_games"
+    replay_count    = models.IntegerField(default=0)
+    spectator_count = models.IntegerField(default=0)
+    game_count      = models.IntegerField(default=0, db_index=True)
 
     def __unicode__(self):
         return str(self.accountid)+u" "+self.names[:10]
 
-    def replay_count(self):
-        return Player.objects.filter(account=self).count()
+    @models.permalink
+    def get_absolute_url(self):
+        return ('srs.views.player', [self.accountid])
+
+    def name(self):
+        return self.names.split(";")[0]
 
-    def spectator_count(self):
-        return Player.objects.filter(account=self, spectator=True).count()
+class PlayerAlias(models.Model):
+    """
+    one row per name in PlayerAccount.names, with copies of the accounts
+    counters, so the players list is sorted and paginated in the DB
+    """
+    account         = models.ForeignKey(PlayerAccount)
+    name            = models.CharField(max_length=128, db_index=True)
+    replay_count    = models.IntegerField(default=0, db_index=True)
+    spectator_count = models.IntegerField(default=0, db_index=True)
+
+    class Meta:
+        unique_together = (("account", "name"),)
+
+    def __unicode__(self):
+        return self.name
+
+class AccountIdSequence(models.Model):
+    """
+    single row, source of the negative accountids for players without one,
+    see upload.allocate_negative_accountids()
+    """
+    last            = models.IntegerField()
+
+    def __unicode__(self):
+        return str(self.last)
 
 class Player(models.Model):
     account         = models.ForeignKey(PlayerAccount, blank=True, null = True)
@@ -157,6 +209,88 @@ class MapOption(MapModOption):
 class ModOption(MapModOption):
     pass
 
+class IngestJob(models.Model):
+    """
+    background processing of an uploaded replay: fetching map infos and
+    rendering the map images (see ingest.py)
+    """
+    QUEUED          = 0
+    RUNNING         = 1
+    DONE            = 2
+    FAILED          = 3
+    STATUS_CHOICES  = ((QUEUED, "queued"), (RUNNING, "running"), (DONE, "done"), (FAILED, "failed"))
+
+    replay          = models.OneToOneField(Replay)
+    mapname         = models.CharField(max_length=128)
+    status          = models.IntegerField(choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    progress        = models.CharField(max_length=128, blank=True)
+    attempts        = models.IntegerField(default=0)
+    error           = models.CharField(max_length=1024, blank=True)
+    created         = models.DateTimeField(auto_now_add=True)
+    updated         = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u"%s %s" % (self.replay.gameID, self.get_status_display())
+
+class IngestTiming(models.Model):
+    """
+    duration of one stage of the ingestion of a replay (see timing.py)
+    """
+    replay          = models.ForeignKey(Replay)
+    stage           = models.CharField(max_length=32)
+    seconds         = models.FloatField()
+    created         = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return u"%s %s %.3fs" % (self.replay_id, self.stage, self.seconds)
+
+class UploadSession(models.Model):
+    """
+    resumable upload of a demofile in numbered chunks (see
+    upload_sessions.py), the chunks are kept in
+    settings.UPLOAD_SESSION_PATH/<token>/ until the upload is committed
+    """
+    OPEN            = 0
+    COMMITTING      = 1
+    DONE            = 2
+    STATUS_CHOICES  = ((OPEN, "open"), (COMMITTING, "committing"), (DONE, "done"))
+
+    token           = models.CharField(max_length=32, unique=True)
+    uploader        = models.ForeignKey(User, related_name="+")
+    owner           = models.ForeignKey(User, related_name="+")
+    filename        = models.CharField(max_length=256)
+    subject         = models.CharField(max_length=256, blank=True)
+    comment         = models.CharField(max_length=1024, blank=True)
+    tags            = models.CharField(max_length=256, blank=True)
+    size            = models.IntegerField()
+    chunk_size      = models.IntegerField()
+    status          = models.IntegerField(choices=STATUS_CHOICES, default=OPEN)
+    result          = models.CharField(max_length=512, blank=True)
+    created         = models.DateTimeField(auto_now_add=True)
+    updated         = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u"%s %s %s" % (self.token, self.filename, self.get_status_display())
+
+    def num_chunks(self):
+        return max((self.size+self.chunk_size-1)/self.chunk_size, 1)
+
+class SearchTerm(models.Model):
+    """
+    entry of the inverted index of the replay search (see search.py): a
+    word of a replays texts, tags, map, game or players, weight is the sum
+    of the weights of the fields it was found in
+    """
+    term            = models.CharField(max_length=64, db_index=True)
+    replay          = models.ForeignKey(Replay)
+    weight          = models.IntegerField()
+
+    class Meta:
+        unique_together = (("term", "replay"),)
+
+    def __unicode__(self):
+        return u"%s %s %d" % (self.term, self.replay_id, self.weight)
+
 class NewsItem(models.Model):
     text            = models.CharField(max_length=256)
     post_date       = models.DateTimeField(auto_now=True)
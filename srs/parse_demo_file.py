@@ -9,105 +9,491 @@
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import os
 import sys
-from struct import unpack
+import glob
+import json
+import time
+import argparse
+import multiprocessing
+import mmap
+import zlib
+from cStringIO import StringIO
+from struct import Struct, unpack
 from time import localtime, strftime
 from datetime import timedelta
 import pprint
+from collections import namedtuple
+from array import array
 
+# increase when the parsed data changes, invalidates cached results
+PARSER_VERSION = 1
 
-class Parse_demo_file():
-    def __init__(self, filename):
-        self.filename = filename
+#
+# struct DemoFileHeader from rts/System/LoadSave/demofile.h
+#
+DEMOFILE_HEADER = Struct("<16s2i256s16sQ12i")
+DEMOFILE_HEADER_FIELDS = (
+    'magic',                # char magic[16]; ///< DEMOFILE_MAGIC
+    'version',              # int version; ///< DEMOFILE_VERSION
+    'headerSize',           # int headerSize; ///< Size of the DemoFileHeader, minor version number.
+    'versionString',        # char versionString[256]; ///< Spring version string, e.g. "0.75b2", "0.75b2+svn4123"
+    'gameID',               # boost::uint8_t gameID[16]; ///< Unique game identifier. Identical for each player of the game.
+    'unixTime',             # boost::uint64_t unixTime; ///< Unix time when game was started.
+    'scriptSize',           # int scriptSize; ///< Size of startscript.
+    'demoStreamSize',       # int demoStreamSize; ///< Size of the demo stream.
+    'gameTime',             # int gameTime; ///< Total number of seconds game time.
+    'wallclockTime',        # int wallclockTime; ///< Total number of seconds wallclock time.
+    'numPlayers',           # int numPlayers; ///< Number of players for which stats are saved.
+    'playerStatSize',       # int playerStatSize; ///< Size of the entire player statistics chunk.
+    'playerStatElemSize',   # int playerStatElemSize; ///< sizeof(CPlayer::Statistics)
+    'numTeams',             # int numTeams; ///< Number of teams for which stats are saved.
+    'teamStatSize',         # int teamStatSize; ///< Size of the entire team statistics chunk.
+    'teamStatElemSize',     # int teamStatElemSize; ///< sizeof(CTeam::Statistics)
+    'teamStatPeriod',       # int teamStatPeriod; ///< Interval (in seconds) between team stats.
+    'winningAllyTeamsSize', # int winningAllyTeamsSize; ///< The size of the vector of the winning ally teams
+    )
+DEMOFILE_MAGIC = "spring demofile"
+DEMOFILE_GAMEID_OFFSET = 280
+GZIP_MAGIC = "\x1f\x8b"
+
+#
+# struct DemoStreamChunkHeader from rts/System/LoadSave/demofile.h, every
+# packet in the demo stream is prefixed by one
+#
+DEMOSTREAM_CHUNK_HEADER = Struct("<fI")
+DemoPacket = namedtuple("DemoPacket", "gametime type data")
 
-    def read_blob(self, seek_size, blob_size):
-        self.demofile.seek(seek_size)
-        return self.demofile.read(blob_size)
+#
+# struct PlayerStatistics and TeamStatistics from rts/System/LoadSave/demofile.h,
+# all members are 4 byte ints ('i') or floats ('f')
+#
+PLAYER_STATISTICS = (
+    ('numCommands', 'i'),
+    ('unitCommands', 'i'),
+    ('mousePixels', 'i'),
+    ('mouseClicks', 'i'),
+    ('keyPresses', 'i'),
+    )
+TEAM_STATISTICS = (
+    ('frame', 'i'),
+    ('metalUsed', 'f'), ('energyUsed', 'f'),
+    ('metalProduced', 'f'), ('energyProduced', 'f'),
+    ('metalExcess', 'f'), ('energyExcess', 'f'),
+    ('metalReceived', 'f'), ('energyReceived', 'f'),
+    ('metalSent', 'f'), ('energySent', 'f'),
+    ('damageDealt', 'f'), ('damageReceived', 'f'),
+    ('unitsProduced', 'i'), ('unitsDied', 'i'),
+    ('unitsReceived', 'i'), ('unitsSent', 'i'),
+    ('unitsCaptured', 'i'), ('unitsOutCaptured', 'i'),
+    ('unitsKilled', 'i'),
+    )
 
-    def read_blob_into_int(self, seek_size, blob_size):
-        return unpack('i', self.read_blob(seek_size, blob_size))
 
-    def make_numeric(self, val):
-        if val.isdigit():
-            return int(val)
-        else:
-            try:
-                return float(val)
-            except ValueError, TypeError:
-                pass
+def decode_stat_columns(blob, fields):
+    """
+    decode a chunk of consecutive statistics structs into one array.array
+    column per struct member: {"metalUsed": array('f', [..]), ..}
+    """
+    columns = {}
+    stride = len(fields)
+    views = {}
+    for typecode in set(t for _, t in fields):
+        views[typecode] = array(typecode, blob)
+        if sys.byteorder == "big":
+            views[typecode].byteswap()
+    for num, (name, typecode) in enumerate(fields):
+        columns[name] = views[typecode][num::stride]
+    return columns
+
+#
+# start script sections that have subentries (for each team) and "flat" ones
+#
+SCRIPT_SUBSECTIONS = re.compile("^(allyteam|player|team)(.*)$")
+SCRIPT_FLATSECTIONS = ("mapoptions", "modoptions", "restrict")
+NUMERIC = re.compile(r"[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$")
+
+
+def format_game_id(raw):
+    """
+    the gameID as it is stored in Replay.gameID
+    """
+    return "%x%x%x%x%x%x%x%x%x%x%x%x%x%x%x%x" % unpack("16B", raw)
+
+def sniff_game_id(data):
+    """
+    decode the gameID from the first bytes of a (possibly gzip compressed)
+    demo, at least the first 296 (uncompressed) bytes are needed
+    - may raise Exception when data is not (the start of) a spring demofile
+    """
+    end = DEMOFILE_GAMEID_OFFSET+16
+    if str(data[:2]) == GZIP_MAGIC:
+        head = GzipBuffer(StringIO(data))[:end]
+    else:
+        head = str(data[:end])
+    if len(head) < end or not head.startswith(DEMOFILE_MAGIC):
+        raise Exception("Not a spring demofile.")
+    return format_game_id(head[DEMOFILE_GAMEID_OFFSET:end])
+
+def make_numeric(val):
+    if val.isdigit():
+        return int(val)
+    elif val[0] in "+-.0123456789" and NUMERIC.match(val):
+        return float(val)
+    else:
         return val
 
+def parse_script(script):
+    """
+    single pass tokenizer for the start script (see Parse_demo_file.parse()),
+    returns the game_setup dict
+    Sections nested deeper than the ones listed in SCRIPT_SUBSECTIONS and
+    SCRIPT_FLATSECTIONS are stored as dicts in their parent section.
+    - may raise Exception when there is no [game] section
+    """
+    game_setup = {
+        'allyteam': {},
+        'mapoptions': {},
+        'modoptions': {},
+        'player': {},
+        'restrict': {},
+        'team': {},
+        'host': {}
+        }
+    host = game_setup['host']
+    found_game = False
+    # open sections: (dict, parent dict, key), the dict is added to its
+    # parent when the section is closed and not empty
+    stack = []
+    current = None
+    name = None
+
+    for line in script.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        elif line[0] == "[" and line[-1] == "]":
+            name = line[1:-1]
+        elif line == "{":
+            if not stack:
+                if name == "game":
+                    found_game = True
+                    stack.append((host, None, None))
+                else:
+                    stack.append(({}, None, None))
+            elif stack[-1][0] is host:
+                sub = SCRIPT_SUBSECTIONS.match(name)
+                if sub:
+                    parent = game_setup[sub.group(1)]
+                    stack.append((parent.get(sub.group(2), {}), parent, sub.group(2)))
+                elif name in SCRIPT_FLATSECTIONS:
+                    stack.append((game_setup[name], None, None))
+                else:
+                    stack.append(({}, None, None))
+            else:
+                parent = stack[-1][0]
+                stack.append((parent.get(name, {}), parent, name))
+            name = None
+            current = stack[-1][0]
+        elif line == "}":
+            if stack:
+                section, parent, key = stack.pop()
+                if section and parent is not None:
+                    parent[key] = section
+                current = stack[-1][0] if stack else None
+        elif current is not None:
+            key, _, val = line.partition("=")
+            key = key.strip()
+            if key:
+                if val[-1:] == ";":
+                    val = val[:-1]
+                val = val.strip()
+                if val:
+                    val = make_numeric(val)
+                current[key] = val
+
+    if not found_game:
+        raise Exception("No [game] section in start script.")
+    return game_setup
+
+
+class GzipBuffer(object):
+    """
+    read-only view of a gzip compressed demo (.sdfz) that inflates the
+    stream incrementally, only as far as it is accessed. Supports slicing
+    (returns str), view() and release(), but not the buffer interface.
+    """
+    chunk_size = 64*1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.inflater = zlib.decompressobj(16+zlib.MAX_WBITS)
+        self.data = bytearray()
+        self.start = 0  # offset of self.data[0] in the uncompressed stream
+        self.eof = False
+
+    def _inflate_to(self, end):
+        while self.start+len(self.data) < end and not self.eof:
+            chunk = self.fileobj.read(self.chunk_size)
+            if chunk:
+                self.data += self.inflater.decompress(chunk)
+            else:
+                self.data += self.inflater.flush()
+                self.eof = True
+
+    def __len__(self):
+        self._inflate_to(sys.maxint)
+        return self.start+len(self.data)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key+1]
+        start = key.start or 0
+        stop = sys.maxint if key.stop is None else key.stop
+        if start < self.start:
+            raise IndexError("GzipBuffer: offset %d was already released" % start)
+        self._inflate_to(stop)
+        return str(self.data[start-self.start:stop-self.start])
+
+    def view(self, offset, size):
+        return self[offset:offset+size]
+
+    def release(self, offset):
+        """
+        drop the inflated data before offset, it cannot be accessed anymore
+        """
+        drop = offset-self.start
+        if drop >= 16*self.chunk_size:
+            del self.data[:drop]
+            self.start = offset
+
+    def skip(self, offset):
+        """
+        inflate up to offset without keeping the data before it
+        """
+        while True:
+            drop = min(offset-self.start, len(self.data))
+            if drop > 0:
+                del self.data[:drop]
+                self.start += drop
+            if self.start >= offset or self.eof:
+                break
+            self._inflate_to(self.start+1)
+
+
+class Parse_demo_file():
+    def __init__(self, filename=None, data=None):
+        """
+        filename: path to a .sdf, it will be mmap'd while parsing
+        data: alternatively the content of a .sdf (str, buffer, bytearray or
+              mmap), so it doesn't have to be written to disk first
+        gzip compressed demos (.sdfz) are recognized by their magic and
+        inflated only as far as needed
+        """
+        self.filename = filename
+        self.data = data
+        self._file = None
+        self._buf = None
+
+    def _open(self):
+        """
+        make the demo available as a buffer in self._buf
+        - may raise IOError when opening a file to read
+        """
+        if self.data is not None:
+            if str(self.data[:2]) == GZIP_MAGIC:
+                self._buf = GzipBuffer(StringIO(self.data))
+            else:
+                self._buf = self.data
+            return self._buf
+        self._file = open(self.filename, "rb")
+        if self._file.read(2) == GZIP_MAGIC:
+            self._file.seek(0)
+            self._buf = GzipBuffer(self._file)
+            return self._buf
+        try:
+            self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            # empty files cannot be mmap'd
+            self._file.seek(0)
+            self._buf = self._file.read()
+        return self._buf
+
+    def _close(self):
+        if isinstance(self._buf, mmap.mmap) and self.data is None:
+            self._buf.close()
+        if self._file:
+            self._file.close()
+        self._file = None
+        self._buf = None
+
     def check_magic(self):
         """
         - may raise IOError when opening a file to read
         """
-        with open(self.filename, "rb") as self.demofile:
+        buf = self._open()
+        try:
             self.header = {}
-            self.header['magic'] = self.read_blob(0, 16)
-            if not self.header['magic'].startswith("spring demofile"):
+            self.header['magic'] = str(buf[:16])
+            if not self.header['magic'].startswith(DEMOFILE_MAGIC):
                 raise Exception("Not a spring demofile.")
+        finally:
+            self._close()
+
+    def read_header(self, buf):
+        """
+        decode the fixed size DemoFileHeader from buf in one go, returns the
+        raw (unformatted) values as a dict
+        - may raise Exception when buf is not a spring demofile
+        """
+        header = str(buf[:DEMOFILE_HEADER.size])
+        if len(header) < DEMOFILE_HEADER.size or not header.startswith(DEMOFILE_MAGIC):
+            raise Exception("Not a spring demofile.")
+        return dict(zip(DEMOFILE_HEADER_FIELDS, DEMOFILE_HEADER.unpack(header)))
+
+#        self.header['void_swab'] = buf[352:self.header['headerSize']]    # lol?
+
+    def iter_packets(self, packet_types=None):
+        """
+        generator walking the demo stream one packet at a time, yields
+        DemoPacket(gametime, type, data) tuples. gametime is the
+        modGameTime (in seconds) the packet was recorded at, type is the
+        NETMSG id (1st byte of the packet) and data is a buffer (no copy)
+        of the whole packet. Only the mmap'd file is kept, so this runs in
+        constant memory regardless of the stream size. The buffers are valid
+        only until the generator is exhausted, use str() to keep a copy.
+        For .sdfz the stream is inflated as it is walked and already
+        consumed data is released, data is a str then.
+        packet_types: if not None, only packets whose type is in it are yielded
+        - may raise IOError when opening a file to read
+        - may raise Exception when file is not a spring demofile
+        """
+        buf = self._open()
+        try:
+            h = self.read_header(buf)
+            if packet_types is not None:
+                packet_types = frozenset(packet_types)
+            if isinstance(buf, GzipBuffer):
+                view = buf.view
+                release = buf.release
+            else:
+                view = lambda offset, size: buffer(buf, offset, size)
+                release = None
+            chunk_header_size = DEMOSTREAM_CHUNK_HEADER.size
+            unpack_chunk = DEMOSTREAM_CHUNK_HEADER.unpack_from
+            pos = h['headerSize']+h['scriptSize']
+            end = pos+h['demoStreamSize']
+            while pos+chunk_header_size < end:
+                # chunk header and the packet type
+                chunk = str(buf[pos:pos+chunk_header_size+1])
+                if len(chunk) <= chunk_header_size:
+                    break
+                gametime, length = unpack_chunk(chunk)
+                pos += chunk_header_size
+                if length == 0 or pos+length > end:
+                    # truncated stream (crashed / incomplete recording)
+                    break
+                ptype = ord(chunk[-1])
+                if packet_types is None or ptype in packet_types:
+                    data = view(pos, length)
+                    if len(data) < length:
+                        break
+                    yield DemoPacket(gametime, ptype, data)
+                pos += length
+                if release:
+                    release(pos)
+        finally:
+            self._close()
 
-    def parse(self):
+    def parse_stats(self):
+        """
+        decodes the player and team statistics chunks at the end of the demo,
+        populates self.player_stats and self.team_stats
+        self.player_stats: {"keyPresses": array('i', [player0, player1, ..]), ..}
+        self.team_stats: [team0, team1, ..] with
+            teamN: {"metalProduced": array('f', [period0, period1, ..]), ..}
+        Both are None if the stats structs of this engine version are
+        unknown (elem size mismatch).
+        - may raise IOError when opening a file to read
+        - may raise Exception when file is not a spring demofile
+        """
+        buf = self._open()
+        try:
+            h = self.read_header(buf)
+            pos = h['headerSize']+h['scriptSize']+h['demoStreamSize']+h['winningAllyTeamsSize']
+            if isinstance(buf, GzipBuffer):
+                buf.skip(pos)
+            player_stats = str(buf[pos:pos+h['playerStatSize']])
+            pos += h['playerStatSize']
+            team_stats = str(buf[pos:pos+h['teamStatSize']])
+        finally:
+            self._close()
+
+        self.player_stats = None
+        elem_size = 4*len(PLAYER_STATISTICS)
+        if h['playerStatElemSize'] == elem_size and len(player_stats) == h['numPlayers']*elem_size:
+            self.player_stats = decode_stat_columns(player_stats, PLAYER_STATISTICS)
+
+        # team stats chunk: one int per team with the number of stats
+        # periods saved for it, then all periods of team0, team1, ..
+        self.team_stats = None
+        elem_size = 4*len(TEAM_STATISTICS)
+        if h['teamStatElemSize'] == elem_size and len(team_stats) >= h['numTeams']*4:
+            periods = array('i', team_stats[:h['numTeams']*4])
+            if sys.byteorder == "big":
+                periods.byteswap()
+            if len(team_stats) == h['numTeams']*4+sum(periods)*elem_size:
+                self.team_stats = []
+                pos = h['numTeams']*4
+                for num in periods:
+                    self.team_stats.append(decode_stat_columns(team_stats[pos:pos+num*elem_size], TEAM_STATISTICS))
+                    pos += num*elem_size
+
+    def parse_winners(self):
+        """
+        reads the winning ally teams behind the demo stream, populates
+        self.winningAllyTeams
+        - may raise IOError when opening a file to read
+        - may raise Exception when file is not a spring demofile
+        """
+        buf = self._open()
+        try:
+            h = self.read_header(buf)
+            pos = h['headerSize']+h['scriptSize']+h['demoStreamSize']
+            if isinstance(buf, GzipBuffer):
+                buf.skip(pos)
+            self.winningAllyTeams = list(bytearray(buf[pos:pos+h['winningAllyTeamsSize']]))
+        finally:
+            self._close()
+
+    def parse(self, winners=True):
         """
         reads data from sdf, populates self.header and self.game_setup
+        winners: also populate self.winningAllyTeams. For compressed demos
+                 (.sdfz) False means only the header and the start script are
+                 inflated, parse_winners() can be called later if needed.
         - may raise IOError when opening a file to read or write
         - may raise Exception when file is not a spring demofile
         """
-        self.demofile = open(self.filename, "rb")
+        buf = self._open()
+        try:
+            self.header = self.read_header(buf)
 
-        #
-        # struct DemoFileHeader from rts/System/LoadSave/demofile.h
-        #
-        self.header = {}
-        self.header['magic'] = self.read_blob(0, 16)                             # char magic[16]; ///< DEMOFILE_MAGIC
-        if not self.header['magic'].startswith("spring demofile"):
-            raise Exception("Not a spring demofile.")
-        self.header['version'] = self.read_blob_into_int(16, 4)[0]               # int version; ///< DEMOFILE_VERSION
-        self.header['headerSize'] = self.read_blob_into_int(20, 4)[0]            # int headerSize; ///< Size of the DemoFileHeader, minor version number.
-        self.header['versionString'] = self.read_blob(24, 256)                   # char versionString[256]; ///< Spring version string, e.g. "0.75b2", "0.75b2+svn4123"
-        self.header['gameID'] = self.read_blob(280, 16)                          # boost::uint8_t gameID[16]; ///< Unique game identifier. Identical for each player of the game.
-        self.header['unixTime'] = self.read_blob(296, 8)                         # boost::uint64_t unixTime; ///< Unix time when game was started.
-        self.header['scriptSize'] = self.read_blob_into_int(304, 4)[0]           # int scriptSize; ///< Size of startscript.
-        self.header['demoStreamSize'] = self.read_blob_into_int(308, 4)[0]       # int demoStreamSize; ///< Size of the demo stream.
-        self.header['gameTime'] = self.read_blob_into_int(312, 4)[0]             # int gameTime; ///< Total number of seconds game time.
-        self.header['wallclockTime'] = self.read_blob_into_int(316, 4)[0]        # int wallclockTime; ///< Total number of seconds wallclock time.
-        self.header['numPlayers'] = self.read_blob_into_int(320, 4)[0]           # int numPlayers; ///< Number of players for which stats are saved.
-        self.header['playerStatSize'] = self.read_blob_into_int(324, 4)[0]       # int playerStatSize; ///< Size of the entire player statistics chunk.
-        self.header['playerStatElemSize'] = self.read_blob_into_int(328, 4)[0]   # int playerStatElemSize; ///< sizeof(CPlayer::Statistics)
-        self.header['numTeams'] = self.read_blob_into_int(332, 4)[0]             # int numTeams; ///< Number of teams for which stats are saved.
-        self.header['teamStatSize'] = self.read_blob_into_int(336, 4)[0]         # int teamStatSize; ///< Size of the entire team statistics chunk.
-        self.header['teamStatElemSize'] = self.read_blob_into_int(340, 4)[0]     # int teamStatElemSize; ///< sizeof(CTeam::Statistics)
-        self.header['teamStatPeriod'] = self.read_blob_into_int(344, 4)[0]       # int teamStatPeriod; ///< Interval (in seconds) between team stats.
-        self.header['winningAllyTeamsSize'] = self.read_blob_into_int(348, 4)[0] # int winningAllyTeamsSize; ///< The size of the vector of the winning ally teams
-
-#        self.header['void_swab']            = self.read_blob(352, self.header['headerSize']-352)    # lol?
-
-        script = self.read_blob(self.header['headerSize'], self.header['scriptSize'])
-
-        self.winningAllyTeams = []
-        winnning_team = 0
-        self.demofile.seek(self.header['headerSize']+self.header['scriptSize']+self.header['demoStreamSize'])
-        while winnning_team < self.header['winningAllyTeamsSize']:
-            team = unpack('B', self.read_blob(self.demofile.tell(), 1))
-            self.winningAllyTeams.append(team[0])
-            winnning_team += 1
-
-
-#        demo_stream = self.read_blob(self.demofile.tell(), self.header['demoStreamSize'])
-#        i = 0
-#        player_stats = []
-#        while i < self.header['numPlayers']:
-#            player_stats[i] = self.read_blob(self.demofile.tell(), self.header['playerStatElemSize'])
-#            i += 1
-
-
-
-        self.demofile.close()
-
-        self.header['magic']         = str(self.header['magic']).partition("\x00")[0]
-        self.header['versionString'] = str(self.header['versionString']).partition("\x00")[0]
-        self.header['gameID']        = "%x%x%x%x%x%x%x%x%x%x%x%x%x%x%x%x" % unpack("BBBBBBBBBBBBBBBB", self.header['gameID'])
-        self.header['unixTime']      = "%s" % strftime("%Y-%m-%d %H:%M:%S", localtime(unpack("Q", self.header['unixTime'])[0]))
+            script_start = self.header['headerSize']
+            script = str(buf[script_start:script_start+self.header['scriptSize']])
+
+            if winners:
+                winners_start = script_start+self.header['scriptSize']+self.header['demoStreamSize']
+                if isinstance(buf, GzipBuffer):
+                    buf.skip(winners_start)
+                self.winningAllyTeams = list(bytearray(buf[winners_start:winners_start+self.header['winningAllyTeamsSize']]))
+        finally:
+            self._close()
+
+        self.header['magic']         = self.header['magic'].partition("\x00")[0]
+        self.header['versionString'] = self.header['versionString'].partition("\x00")[0]
+        self.header['gameID']        = format_game_id(self.header['gameID'])
+        self.header['unixTime']      = "%s" % strftime("%Y-%m-%d %H:%M:%S", localtime(self.header['unixTime']))
         self.header['gameTime']      = "%s" % str(timedelta(seconds=self.header['gameTime']))
         self.header['wallclockTime'] = "%s" % str(timedelta(seconds=self.header['wallclockTime']))
 
@@ -169,75 +555,102 @@ class Parse_demo_file():
     #  -->  # game_setup["modoptions"]["deathmode"] = "com"
     #
 
-        self.game_setup = {
-			'allyteam': {},
-			'mapoptions': {},
-			'modoptions': {},
-			'player': {},
-			'restrict': {},
-			'team': {},
-			'host': {}
-			}
+        self.game_setup = parse_script(script)
 
-        game = re.match('^\[game\]\n\{(?P<data>.*)\}\n', script, re.DOTALL).groupdict()
-        section_iter = re.finditer('\[(?P<name>.*?)\]\n\{(?P<data>.*?)\}\n', game['data'], re.DOTALL)
 
-        while True:
-            try:
-                section_ = section_iter.next()
-                section = section_.groupdict()
-                if section and section['data'].strip():
-                    # these have subentries (for each team)
-                    for sec in ["allyteam", "player", "team"]:
-                        if section['name'].startswith(sec):
-                            subsec = section['name'].split(sec)[1]
-                            if not subsec in self.game_setup[sec]:
-                                self.game_setup[sec][subsec] = {}
-                            for data in section['data'].strip().split(";\n"):
-                                if data.strip():
-                                    nam, val = data.split('=', 1)
-                                    if nam:
-                                        if val:
-                                            if val[-1] == ";": val = val[:-1]
-                                            val = self.make_numeric(val.strip())
-                                        self.game_setup[sec][subsec][nam] = val
-                    # these are "flat"
-                    for sec in ["mapoptions", "modoptions", "restrict"]:
-                        if section['name'] == sec:
-                            for data in section['data'].strip().split(";\n"):
-                                if data.strip():
-                                    nam, val = data.split('=', 1)
-                                    if val[-1] == ";": val = val[:-1]
-                                    val = self.make_numeric(val.strip())
-                                    self.game_setup[sec][nam] = val
-            except StopIteration:
-                break
+def find_demofiles(paths):
+    """
+    generator expanding globs and walking directories, yields paths of
+    .sdf and .sdfz files (each only once)
+    """
+    seen = set()
+    for arg in paths:
+        for path in glob.glob(arg) or [arg]:
+            if os.path.isdir(path):
+                found = (os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk(path) for filename in sorted(filenames) if filename.lower().endswith((".sdf", ".sdfz")))
+            else:
+                found = [path]
+            for demofile in found:
+                if demofile not in seen:
+                    seen.add(demofile)
+                    yield demofile
 
-        for data in game['data'].split("}")[-1:][0].strip().split(";"):
-            if data:
-                self.game_setup['host'][data.split("=", 1)[0].strip()] = data.split("=", 1)[1].strip()
-        for k,v in self.game_setup['host'].items():
-            self.game_setup['host'][k] = self.make_numeric(v)
+def parse_to_json(path):
+    """
+    worker for batch mode, returns (path, size, json line, error)
+    """
+    try:
+        size = os.path.getsize(path)
+        replay = Parse_demo_file(path)
+        replay.parse()
+        result = {'path': path, 'header': replay.header, 'game_setup': replay.game_setup, 'winningAllyTeams': replay.winningAllyTeams}
+        try:
+            line = json.dumps(result)
+        except UnicodeDecodeError:
+            # player names etc are not always utf-8
+            line = json.dumps(result, encoding="latin-1")
+        return (path, size, line, None)
+    except Exception, e:
+        return (path, 0, None, "%s: %s" % (e.__class__.__name__, e))
 
+def batch_parse(paths, out, processes=None):
+    """
+    parse all demofiles in paths in a process pool, write one JSON line per
+    replay to out, report errors and throughput on stderr
+    returns the number of files that could not be parsed
+    """
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    files = errors = total_bytes = 0
+    start = time.time()
+    try:
+        for path, size, line, error in pool.imap_unordered(parse_to_json, find_demofiles(paths), chunksize=16):
+            files += 1
+            if error:
+                errors += 1
+                print >> sys.stderr, "%s: %s" % (path, error)
+            else:
+                total_bytes += size
+                out.write(line+"\n")
+        pool.close()
+    except BaseException:
+        # KeyboardInterrupt or e.g. an IOError writing out, join() needs a
+        # closed or terminated pool
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    duration = max(time.time()-start, 0.000001)
+    print >> sys.stderr, "parsed %d files (%d errors, %.1f MB) in %.1fs: %.1f files/s, %.1f MB/s" % (files, errors, total_bytes/1048576.0, duration, files/duration, total_bytes/1048576.0/duration)
+    return errors
 
 def main(argv=None):
-    if argv is None:
-        argv = sys.argv
-        if len(argv) == 1:
-            print "Usage: %s demofile" % (argv[0])
-            return 1
-        replay = Parse_demo_file(argv[1])
-        replay.parse()
+    parser = argparse.ArgumentParser(description="Parse spring demo files (.sdf/.sdfz).")
+    parser.add_argument("-b", "--batch", help="batch mode: parse all files in parallel and write one JSON line per replay", action="store_true")
+    parser.add_argument("-o", "--output", help="batch mode: write JSON lines to this file instead of stdout")
+    parser.add_argument("-j", "--processes", help="batch mode: number of worker processes (default: number of CPUs)", type=int)
+    parser.add_argument("path", nargs="+", help="demofile, in batch mode also directories and globs")
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        if args.output:
+            with open(args.output, "wb") as out:
+                errors = batch_parse(args.path, out, args.processes)
+        else:
+            errors = batch_parse(args.path, sys.stdout, args.processes)
+        return int(errors > 0)
+
+    replay = Parse_demo_file(args.path[0])
+    replay.parse()
 
-        pp = pprint.PrettyPrinter(depth=6)
+    pp = pprint.PrettyPrinter(depth=6)
 
-        print "#################### header ##########################"
-        pp.pprint(replay.header)
-        print "################## game_setup ########################"
-        pp.pprint(replay.game_setup)
-        print "############### winningAllyTeams #####################"
-        pp.pprint(replay.winningAllyTeams)
-        return 0
+    print "#################### header ##########################"
+    pp.pprint(replay.header)
+    print "################## game_setup ########################"
+    pp.pprint(replay.game_setup)
+    print "############### winningAllyTeams #####################"
+    pp.pprint(replay.winningAllyTeams)
+    return 0
 
 if __name__ == "__main__":
     sys.exit(main())
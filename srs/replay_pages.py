@@ -0,0 +1,93 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# rendered, user independent parts of the replay detail page (info box,
+# teams, comments), kept per gameID in the "replay_pages" cache of
+# settings.CACHES and dropped on edit, comment and re-processing
+# The download counter changes too often to be cached, it is inserted per
+# request.
+#
+
+import logging
+
+from django.core.cache import get_cache
+from django.db.models.signals import post_save, post_delete
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from models import *
+
+logger = logging.getLogger(__package__)
+
+# placeholder of the download counter in the cached info box
+DOWNLOAD_COUNT_MARK = "<!--srs_download_count-->"
+
+
+def get_cache_backend():
+    return get_cache("replay_pages")
+
+def cache_key(gameID):
+    return "srs_replay_%s" % gameID
+
+def load_tree(replay):
+    """
+    fetch everything the fragments show in a fixed number of queries
+    (allyteams, teams with leaders and their accounts, spectators, the
+    templates query tags and comments)
+    returns the template context
+    """
+    teams = {}
+    for team in Team.objects.filter(replay=replay).select_related("teamleader", "teamleader__account").order_by("pk"):
+        teams.setdefault(team.allyteam_id, []).append(team)
+    allyteams = [(at, teams[at.pk]) for at in Allyteam.objects.filter(replay=replay).order_by("pk") if at.pk in teams]
+    specs = list(Player.objects.filter(replay=replay, spectator=True).order_by("pk"))
+    return {"replay": replay, "allyteams": allyteams, "specs": specs, "download_count": mark_safe(DOWNLOAD_COUNT_MARK),
+            "STATIC_URL": settings.STATIC_URL}
+
+def render_fragments(replay):
+    context = load_tree(replay)
+    return {"box": render_to_string("replay_box.html", context),
+            "teams": render_to_string("replay_teams.html", context),
+            "comments": render_to_string("replay_comments.html", context)}
+
+def get_fragments(replay, cache=True):
+    """
+    returns the rendered fragments of replay from the cache, or renders
+    (and caches them, if cache is True), with the current download counter
+    replay: fetched with select_related("uploader", "map_info", "replayfile")
+    """
+    fragments = get_cache_backend().get(cache_key(replay.gameID))
+    if fragments is None:
+        fragments = render_fragments(replay)
+        if cache:
+            get_cache_backend().set(cache_key(replay.gameID), fragments)
+            logger.debug("rendered replay page gameID=%s", replay.gameID)
+    fragments = dict(fragments, box=fragments["box"].replace(DOWNLOAD_COUNT_MARK, str(replay.replayfile.download_count)))
+    return fragments
+
+def invalidate(gameID):
+    """
+    drop the fragments of a replay, call after committing the change
+    """
+    get_cache_backend().delete(cache_key(gameID))
+
+# edit_replay() and the admin save the replay, the upload and ingestion use
+# update() and call invalidate() themselves
+def replay_changed(sender, instance, **kwargs):
+    invalidate(instance.gameID)
+
+def comment_changed(sender, instance, **kwargs):
+    if instance.content_type_id == ContentType.objects.get_for_model(Replay).pk:
+        for gameID in Replay.objects.filter(pk=instance.object_pk).values_list("gameID", flat=True):
+            invalidate(gameID)
+
+post_save.connect(replay_changed, sender=Replay, dispatch_uid="replay_pages_Replay_save")
+post_delete.connect(replay_changed, sender=Replay, dispatch_uid="replay_pages_Replay_delete")
+post_save.connect(comment_changed, sender=Comment, dispatch_uid="replay_pages_Comment_save")
+post_delete.connect(comment_changed, sender=Comment, dispatch_uid="replay_pages_Comment_delete")
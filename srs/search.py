@@ -0,0 +1,178 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# replay search: an inverted index (SearchTerm rows) of the words of the
+# title, description, game type, map, tags, player names / aliases and
+# uploader of each replay, updated on upload and edit and rebuilt with
+# "manage.py rebuild_search_index"
+# Queries match replays containing all words as prefixes of indexed words,
+# ranked by the summed weights of the matched fields.
+#
+
+import re
+import logging
+
+from django.db import connection, transaction
+from django.utils.encoding import force_unicode
+
+from models import *
+
+logger = logging.getLogger(__package__)
+
+# weight of a word per field it is found in
+WEIGHTS = {"title": 5, "tags": 4, "map": 4, "gametype": 3, "players": 3, "uploader": 2, "description": 1}
+# factor for words that match a query word exactly (not only as prefix)
+EXACT_FACTOR = 2
+TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def tokenize(text):
+    """
+    returns the lower case words of text, in order, with duplicates
+    """
+    return [word[:TERM_LENGTH] for word in WORD_RE.findall(text.lower())]
+
+def replay_terms(replay, mapname, tags, names, uploader):
+    """
+    returns {term: weight} for a replay
+    """
+    fields = (("title", [replay.title]), ("description", [replay.long_text]), ("gametype", [replay.gametype]),
+              ("map", [mapname]), ("tags", tags), ("players", names), ("uploader", [uploader]))
+    terms = {}
+    for field, texts in fields:
+        # names from the demofile may be byte strings
+        for term in set(tokenize(u" ".join([force_unicode(text, errors="replace") for text in texts]))):
+            terms[term] = terms.get(term, 0)+WEIGHTS[field]
+    return terms
+
+def index_replay(replay, mapname=None, tags=None, names=None):
+    """
+    (re)build the index entries of a replay, data not passed is queried
+    mapname: name of the map (replay.map_info is not set during the upload)
+    tags: names of the tags
+    names: names of the players and aliases of their accounts
+    """
+    if mapname is None:
+        mapname = replay.map_info.name if replay.map_info else ""
+    if tags is None:
+        tags = list(replay.tags.values_list("name", flat=True))
+    if names is None:
+        names = list(Player.objects.filter(replay=replay).values_list("name", flat=True))
+        names.extend(PlayerAccount.objects.filter(player__replay=replay).values_list("names", flat=True))
+    terms = replay_terms(replay, mapname, tags, names, replay.uploader.username)
+    SearchTerm.objects.filter(replay=replay).delete()
+    SearchTerm.objects.bulk_create([SearchTerm(term=term, replay=replay, weight=weight) for term, weight in terms.items()])
+
+def rebuild_index(batch_size=500):
+    """
+    rebuild the index of all replays, in a transaction per batch of replays
+    returns the number of indexed replays
+    """
+    pks = list(Replay.objects.order_by("pk").values_list("pk", flat=True))
+    for start in range(0, len(pks), batch_size):
+        index_batch(pks[start:start+batch_size])
+        logger.info("indexed %d/%d replays", min(start+batch_size, len(pks)), len(pks))
+    return len(pks)
+
+@transaction.commit_on_success
+def index_batch(replay_pks):
+    """
+    (re)build the index entries of some replays, in a constant number of
+    queries
+    """
+    replays = Replay.objects.filter(pk__in=replay_pks).select_related("map_info", "uploader")
+    tags = {}
+    for replay_pk, name in Replay.tags.through.objects.filter(replay__in=replay_pks).values_list("replay", "tag__name"):
+        tags.setdefault(replay_pk, []).append(name)
+    names = {}
+    for replay_pk, name, aliases in Player.objects.filter(replay__in=replay_pks).values_list("replay", "name", "account__names"):
+        names.setdefault(replay_pk, []).extend([name, aliases or ""])
+
+    new_terms = []
+    for replay in replays:
+        terms = replay_terms(replay, replay.map_info.name if replay.map_info else "", tags.get(replay.pk, []),
+                             names.get(replay.pk, []), replay.uploader.username)
+        new_terms.extend([SearchTerm(term=term, replay=replay, weight=weight) for term, weight in terms.items()])
+    SearchTerm.objects.filter(replay__in=replay_pks).delete()
+    SearchTerm.objects.bulk_create(new_terms)
+
+def query_terms(query):
+    """
+    the words of a search query, without those that are a prefix of another
+    one (they would match the same index entries)
+    """
+    words = []
+    for word in tokenize(query):
+        if word not in words:
+            words.append(word)
+    words = words[:MAX_QUERY_TERMS]
+    return [word for word in words if not any(other != word and other.startswith(word) for other in words)]
+
+class SearchResults(object):
+    """
+    the replays matching a search query, best first, fetched one slice at a
+    time (supports count() and slicing, so it can be used with a Paginator)
+    Each replay has its rank in the attribute "score".
+    """
+    def __init__(self, query):
+        self.terms = query_terms(query)
+        self._count = None
+
+    def _matches_sql(self):
+        """
+        returns (sql, params) of the matching replay pks and their scores
+        """
+        qn = connection.ops.quote_name
+        term = qn(SearchTerm._meta.get_field("term").column)
+        replay = qn(SearchTerm._meta.get_field("replay").column)
+        weight = qn(SearchTerm._meta.get_field("weight").column)
+        # a stored word matches at most one query word (see query_terms()),
+        # so all words matched if the number of distinct matches is right
+        sql = "SELECT %s AS replay_id, SUM(%s * CASE WHEN %s IN (%s) THEN %d ELSE 1 END) AS score FROM %s WHERE %s GROUP BY %s HAVING COUNT(DISTINCT CASE %s END) = %d" % (
+            replay, weight, term, ", ".join(["%s"]*len(self.terms)), EXACT_FACTOR, qn(SearchTerm._meta.db_table),
+            " OR ".join(["%s LIKE %%s" % term]*len(self.terms)), replay,
+            " ".join(["WHEN %s LIKE %%s THEN %d" % (term, num) for num in range(len(self.terms))]), len(self.terms))
+        # tokenize() leaves no LIKE wildcards in the terms
+        patterns = [t+"%" for t in self.terms]
+        return sql, self.terms+patterns+patterns
+
+    def count(self):
+        if self._count is None:
+            if self.terms:
+                sql, params = self._matches_sql()
+                cursor = connection.cursor()
+                cursor.execute("SELECT COUNT(*) FROM (%s) matches" % sql, params)
+                self._count = cursor.fetchone()[0]
+            else:
+                self._count = 0
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step:
+            raise TypeError("SearchResults support only slices")
+        start = key.start or 0
+        stop = self.count() if key.stop is None else key.stop
+        if not self.terms or stop <= start:
+            return []
+        sql, params = self._matches_sql()
+        cursor = connection.cursor()
+        cursor.execute("%s ORDER BY score DESC, replay_id DESC LIMIT %d OFFSET %d" % (sql, stop-start, start), params)
+        scores = cursor.fetchall()
+        replays = Replay.objects.select_related("map_info", "uploader").in_bulk([pk for pk, _ in scores])
+        result = []
+        for pk, score in scores:
+            if pk in replays:
+                replays[pk].score = score
+                result.append(replays[pk])
+        return result
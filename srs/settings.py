@@ -7,6 +7,24 @@ IMG_PATH = SRS_FILE_ROOT+"/static/img/"
 MAPS_PATH = SRS_FILE_ROOT+"/static/maps/"
 REPLAYS_PATH = SRS_FILE_ROOT+"/static/replays/"
 FONTS_PATH = SRS_FILE_ROOT+"/static/fonts/"
+DEMOFILE_CACHE_PATH = SRS_FILE_ROOT+"/static/demofile_cache/"
+DEMOFILE_CACHE_SIZE = 256*1024*1024 # bytes, least recently used entries are removed above this
+INGEST_ASYNC = True         # fetch maps and render images in "manage.py ingest_worker", not in the upload request
+INGEST_WORKERS = 2          # worker threads of "manage.py ingest_worker"
+INGEST_POLL_INTERVAL = 2    # seconds between checks for new IngestJobs
+INGEST_MAX_ATTEMPTS = 3     # a failing IngestJob is retried this often
+INGEST_JOB_TIMEOUT = 600    # seconds after which a running IngestJob is considered abandoned
+MAP_INFO_BACKEND = "srs.spring_maps.SpringfilesBackend" # or "srs.spring_maps.LocalBackend"
+MAP_INFO_LOCAL_PATH = SRS_FILE_ROOT+"/static/map_info/" # <mapname>.json and images for LocalBackend
+MAP_INFO_NEGATIVE_TTL = 24*3600 # seconds until a map that was not found is looked up again
+MAP_INFO_FETCH_TIMEOUT = 120    # seconds to wait for another process fetching the same map
+REPLAY_STORAGE_COMPRESS = True  # store uncompressed demofiles gzip'd (as .sdfz)
+REPLAY_STORAGE_COMPRESSLEVEL = 6
+INGEST_TIMING_HOURS = 24     # default time span of the ingestion timing statistics
+UPLOAD_SESSION_PATH = SRS_FILE_ROOT+"/upload_sessions/" # chunks of resumable uploads
+UPLOAD_SESSION_TIMEOUT = 24*3600        # seconds after which unfinished upload sessions are removed
+UPLOAD_MAX_SIZE = 256*1024*1024         # bytes, largest demofile accepted by any upload
+UPLOAD_CHUNK_SIZES = (64*1024, 8*1024*1024) # bytes, smallest and largest chunk size of upload sessions
 thumbnail_sizes = {"home": (150, 100), "replay": (340,1000)}
 LOGIN_URL = "/login/"
 LOGOUT_URL = "/logout/"
@@ -21,9 +39,39 @@ SHORT_DATE_FORMAT = 'd.m.Y'
 SHORT_DATETIME_FORMAT = 'd.m.Y H:i:s (T)'
 TEMPLATE_CONTEXT_PROCESSORS = global_settings.TEMPLATE_CONTEXT_PROCESSORS + ("django.core.context_processors.request", )
 AUTHENTICATION_BACKENDS = ('lobbyauth.lobbybackend.LobbyBackend', ) + global_settings.AUTHENTICATION_BACKENDS
-XMLRPC_METHODS = (('srs.upload.xmlrpc_upload', 'xmlrpc_upload'),)
+XMLRPC_METHODS = (('srs.upload.xmlrpc_upload', 'xmlrpc_upload'),
+                  ('srs.upload_sessions.xmlrpc_upload_begin', 'xmlrpc_upload_begin'),
+                  ('srs.upload_sessions.xmlrpc_upload_chunk', 'xmlrpc_upload_chunk'),
+                  ('srs.upload_sessions.xmlrpc_upload_status', 'xmlrpc_upload_status'),
+                  ('srs.upload_sessions.xmlrpc_upload_commit', 'xmlrpc_upload_commit'),
+                  )
 AUTH_PROFILE_MODULE = 'lobbyauth.UserProfile'
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # context shared by all pages (sidebar.py), dropped on invalidation
+    # events. LocMemCache is per process: with several processes (or
+    # "manage.py ingest_worker") use a FileBasedCache, so invalidations
+    # reach all of them, e.g.
+    # 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    # 'LOCATION': SRS_FILE_ROOT+'/sidebar_cache/',
+    'sidebar': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'srs-sidebar',
+        'TIMEOUT': 600, # seconds, bounds staleness of other processes snapshots
+    },
+    # rendered parts of the replay pages per gameID (replay_pages.py), same
+    # considerations as for 'sidebar'
+    'replay_pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'srs-replay-pages',
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+
 LOG_PATH        = realpath(dirname(__file__))+'/log'
 DEBUG_FORMAT = '%(asctime)s %(levelname)-8s %(module)s.%(funcName)s:%(lineno)d  %(message)s'
 INFO_FORMAT  = '%(asctime)s %(levelname)-8s %(message)s'
@@ -0,0 +1,80 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# cached snapshot of the context shared by all pages (totals and top lists
+# of the sidebar, see common.all_page_infos()), kept in the "sidebar" cache
+# of settings.CACHES and rebuilt only after an invalidation event
+#
+
+import logging
+
+from django.core.cache import get_cache
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+
+from models import *
+
+logger = logging.getLogger(__package__)
+
+CACHE_KEY = "srs_sidebar"
+
+# sent when data shown in the sidebar changed, providing the reason (str)
+sidebar_changed = Signal(providing_args=["reason"])
+
+
+def get_cache_backend():
+    return get_cache("sidebar")
+
+def build_context():
+    """
+    the shared context, as lists (a cached snapshot must not query)
+    """
+    latest_comments = list(Comment.objects.reverse()[:5])
+    for comment in latest_comments:
+        # fetch now, so it is cached in the object
+        comment.content_object
+    return {"total_replays"  : Replay.objects.count(),
+            "top_tags"       : list(Tag.objects.annotate(num_replay=Count('replay')).order_by('-num_replay')[:20]),
+            "top_maps"       : list(Map.objects.annotate(num_replay=Count('replay')).order_by('-num_replay')[:20]),
+            "top_players"    : list(PlayerAccount.objects.order_by('-game_count')[:20]),
+            "latest_comments": latest_comments}
+
+def get_context():
+    """
+    returns the shared context from the cache, or builds and caches it
+    """
+    cache = get_cache_backend()
+    context = cache.get(CACHE_KEY)
+    if context is None:
+        context = build_context()
+        cache.set(CACHE_KEY, context)
+        logger.debug("rebuilt sidebar context")
+    return context
+
+def invalidate(reason):
+    """
+    publish an invalidation event, call after committing the change
+    """
+    sidebar_changed.send(sender=None, reason=reason)
+
+@receiver(sidebar_changed)
+def drop_snapshot(sender, reason, **kwargs):
+    logger.debug("sidebar context invalidated: %s", reason)
+    get_cache_backend().delete(CACHE_KEY)
+
+# changes outside of the upload / ingestion code paths (comments, replay
+# edits, admin), the upload uses bulk inserts and updates which send no
+# signals and calls invalidate() after committing
+def model_changed(sender, instance, **kwargs):
+    invalidate("%s pk=%s changed" % (sender.__name__, instance.pk))
+
+for model in (Replay, Tag, Map, PlayerAccount, Comment):
+    post_save.connect(model_changed, sender=model, dispatch_uid="sidebar_%s_save" % model.__name__)
+    post_delete.connect(model_changed, sender=model, dispatch_uid="sidebar_%s_delete" % model.__name__)
@@ -8,42 +8,99 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
+import json
+import time
+import shutil
+import logging
+import datetime
+import threading
 from xmlrpclib import ServerProxy
 import pprint
 import urllib
 from PIL import Image, ImageChops, ImageFont, ImageDraw
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from django.utils.importlib import import_module
 import settings
-from models import Replay, Map, Allyteam
+from models import Replay, Map, MapImg, MapLookup, Allyteam
+import timing
 
-class Spring_maps():
-    def __init__(self, mapname):
-        self.mapname = mapname
+logger = logging.getLogger(__package__)
 
-    def fetch_info(self):
+
+class SpringfilesBackend():
+    """
+    map infos and images from api.springfiles.com
+    """
+    url = 'http://api.springfiles.com/xmlrpc.php'
+
+    def search(self, mapname):
         """
-        fetches map information from api.springfiles.com, stores it in self.map_info
+        returns a list of matching maps (springfiles search results)
         - may raise an Exception when connecting to server
         """
-        proxy = ServerProxy('http://api.springfiles.com/xmlrpc.php', verbose=False)
+        proxy = ServerProxy(self.url, verbose=False)
         searchstring = {
 #    "category" : "Spring Maps",
         "logical" : "or",
-        "tag" : self.mapname,
-        "filename" : self.mapname,
-        "springname" : self.mapname,
+        "tag" : mapname,
+        "filename" : mapname,
+        "springname" : mapname,
         "torrent" : True,
         "metadata" : True,
         "nosensitive" : True,
         "images" : True}
 
-        self.map_info = proxy.springfiles.search(searchstring)
+        return proxy.springfiles.search(searchstring)
+
+    def fetch_img(self, url, filename):
+        urllib.urlretrieve(url, filename)
+
+class LocalBackend():
+    """
+    stand-in for springfiles (tests, benchmarks, offline installations):
+    search results are read from <path>/<mapname>.json, image URLs in them
+    are file names relative to path
+    """
+    def __init__(self, path=None):
+        self.path = path or settings.MAP_INFO_LOCAL_PATH
+
+    def search(self, mapname):
+        try:
+            with open(os.path.join(self.path, mapname+".json")) as result:
+                return json.load(result)
+        except IOError:
+            return []
+
+    def fetch_img(self, url, filename):
+        shutil.copyfile(os.path.join(self.path, url), filename)
+
+def get_backend():
+    """
+    instance of the class in settings.MAP_INFO_BACKEND (dotted path)
+    """
+    module, _, cls = settings.MAP_INFO_BACKEND.rpartition(".")
+    return getattr(import_module(module), cls)()
+
+class Spring_maps():
+    def __init__(self, mapname, backend=None):
+        self.mapname = mapname
+        self.backend = backend or get_backend()
+
+    def fetch_info(self):
+        """
+        fetches map information from api.springfiles.com, stores it in self.map_info
+        - may raise an Exception when connecting to server
+        """
+        self.map_info = self.backend.search(self.mapname)
 
     def fetch_img(self):
         """
         fetches map image from api.springfiles.com
         """
-        urllib.urlretrieve (self.map_info[0]['mapimages'][0], settings.MAPS_PATH+self.mapname+".jpg")
+        self.backend.fetch_img(self.map_info[0]['mapimages'][0], settings.MAPS_PATH+self.mapname+".jpg")
         return self.mapname+".jpg"
 
     def make_home_thumb(self):
@@ -53,6 +110,102 @@ class Spring_maps():
         image.save(settings.MAPS_PATH+self.mapname+"_home.jpg", "JPEG")
         return self.mapname+"_home.jpg"
 
+class MapNotFound(Exception):
+    pass
+
+class MapInfoResolver():
+    """
+    get / create Map objects. Concurrent lookups of the same map are
+    coalesced into one fetch: in this process with a lock per map name,
+    between processes through the MapLookup row of the map. Maps that
+    were not found are not looked up again for
+    settings.MAP_INFO_NEGATIVE_TTL seconds.
+    """
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, backend=None):
+        self.backend = backend or get_backend()
+
+    def _lock(self, mapname):
+        with self._locks_lock:
+            return self._locks.setdefault(mapname, threading.Lock())
+
+    def _get_map(self, mapname):
+        try:
+            return Map.objects.filter(name=mapname).order_by("pk")[0]
+        except IndexError:
+            return None
+
+    def _get_lookup(self, mapname):
+        try:
+            return MapLookup.objects.get_or_create(name=mapname)[0]
+        except IntegrityError:
+            # created concurrently
+            transaction.rollback_unless_managed()
+            return MapLookup.objects.get(name=mapname)
+
+    def resolve(self, mapname, timer=None):
+        """
+        returns the Map object for mapname, fetching its infos and image if
+        this is the first time it is used
+        timer: timing.StageTimer, gets the fetch_info and fetch_img stages
+        - may raise MapNotFound
+        - may raise an Exception when connecting to server
+        """
+        with self._lock(mapname):
+            deadline = time.time()+settings.MAP_INFO_FETCH_TIMEOUT
+            while True:
+                # end the current transaction to see other processes changes
+                transaction.commit_unless_managed()
+                map_info = self._get_map(mapname)
+                if map_info:
+                    return map_info
+                lookup = self._get_lookup(mapname)
+                now = timezone.now()
+                if lookup.status == MapLookup.NOT_FOUND and lookup.updated > now-datetime.timedelta(seconds=settings.MAP_INFO_NEGATIVE_TTL):
+                    raise MapNotFound("Map '%s' not found (cached since %s)." % (mapname, lookup.updated))
+                if lookup.status == MapLookup.FETCHING and lookup.updated > now-datetime.timedelta(seconds=settings.MAP_INFO_FETCH_TIMEOUT) and time.time() < deadline:
+                    # another process is fetching it
+                    time.sleep(1)
+                    continue
+                # compare-and-set, only one process wins
+                if MapLookup.objects.filter(pk=lookup.pk, status=lookup.status, updated=lookup.updated).update(status=MapLookup.FETCHING, updated=now):
+                    transaction.commit_unless_managed()
+                    return self._fetch(lookup, mapname, timer or timing.StageTimer())
+
+    def _fetch(self, lookup, mapname, timer):
+        try:
+            # 1st time upload for this map: fetch info and full map, create
+            # thumb for index page
+            smap = Spring_maps(mapname, self.backend)
+            with timer.stage("fetch_info"):
+                smap.fetch_info()
+            if not smap.map_info:
+                MapLookup.objects.filter(pk=lookup.pk).update(status=MapLookup.NOT_FOUND, updated=timezone.now())
+                transaction.commit_unless_managed()
+                raise MapNotFound("Map '%s' not found." % mapname)
+            startpos = ""
+            for coord in smap.map_info[0]["metadata"]["StartPos"]:
+                startpos += "%f,%f|"%(coord["x"], coord["z"])
+            startpos = startpos[:-1]
+            with timer.stage("fetch_img"):
+                full_img = smap.fetch_img()
+                smap.make_home_thumb()
+            map_info = Map.objects.create(name=mapname, startpos=startpos, height=smap.map_info[0]["metadata"]["Height"], width=smap.map_info[0]["metadata"]["Width"])
+            MapImg.objects.create(filename=full_img, startpostype=-1, map_info=map_info)
+            MapLookup.objects.filter(pk=lookup.pk).update(status=MapLookup.FOUND, updated=timezone.now())
+            transaction.commit_unless_managed()
+            logger.debug("created new map_info and MapImg: map_info.pk=%d", map_info.pk)
+            return map_info
+        except MapNotFound:
+            raise
+        except:
+            # not cached, the next lookup tries again
+            MapLookup.objects.filter(pk=lookup.pk).update(status=MapLookup.ERROR, updated=timezone.now())
+            transaction.commit_unless_managed()
+            raise
+
 def startpos_coord_to_img_coord(smap, st_coord, img):
 #    # magic numbers: font size 14 -> number has around 7x10 px size
 #    # move text a little up and left to show startpos more exact
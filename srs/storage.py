@@ -0,0 +1,114 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# content addressed storage of demofiles: MEDIA_ROOT/<sha1[:2]>/<sha1[2:4]>/<sha1>.sdf(z)
+# ReplayFile.path is the storage root, ReplayFile.filename the name below it
+# Uncompressed demofiles are gzip'd (sha1 of the uncompressed content), the
+# result is a valid .sdfz that Parse_demo_file reads directly.
+#
+
+import os
+import gzip
+import errno
+import shutil
+import logging
+from tempfile import mkstemp
+
+import settings
+import parse_demo_file
+from demofile_cache import hash_demofile
+
+logger = logging.getLogger(__package__)
+
+
+class ReplayStorage():
+    """
+    files are stored once per content, so byte identical uploads share a
+    file, and spread over 65536 directories
+    """
+    def __init__(self, root=settings.MEDIA_ROOT, compress=settings.REPLAY_STORAGE_COMPRESS, compresslevel=settings.REPLAY_STORAGE_COMPRESSLEVEL):
+        self.root = root
+        self.compress = compress
+        self.compresslevel = compresslevel
+
+    def name(self, digest, ext):
+        return os.path.join(digest[:2], digest[2:4], digest+ext)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def store(self, src, digest=None, copy=False):
+        """
+        move (or copy) the file src into the storage, returns its name
+        If the content is already stored, src is only removed (not copied).
+        digest: SHA1 hexdigest of src if already known
+        - may raise IOError/OSError
+        """
+        if not digest:
+            digest = hash_demofile(src)
+        with open(src, "rb") as demofile:
+            gzipped = demofile.read(2) == parse_demo_file.GZIP_MAGIC
+        compress = self.compress and not gzipped
+        name = self.name(digest, ".sdfz" if gzipped or compress else ".sdf")
+        dest = self.path(name)
+
+        if os.path.exists(dest):
+            logger.debug("'%s' is already stored as '%s'", src, name)
+            if not copy:
+                os.remove(src)
+            return name
+
+        try:
+            os.makedirs(os.path.dirname(dest))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        if not copy and not compress:
+            try:
+                os.rename(src, dest)
+                os.chmod(dest, 0644)
+                return name
+            except OSError, e:
+                if e.errno != errno.EXDEV:
+                    raise
+        # compress or copy (other filesystem) to a temp file next to dest,
+        # so dest appears complete or not at all
+        (fd, tmp_path) = mkstemp(dir=os.path.dirname(dest), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as dst, open(src, "rb") as demofile:
+                if compress:
+                    with gzip.GzipFile(digest+".sdf", "wb", self.compresslevel, dst, mtime=0) as gz:
+                        shutil.copyfileobj(demofile, gz, 1024*1024)
+                else:
+                    shutil.copyfileobj(demofile, dst, 1024*1024)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, dest)
+        except:
+            os.remove(tmp_path)
+            raise
+        if not copy:
+            os.remove(src)
+        return name
+
+    def open(self, name):
+        """
+        returns the stored file for reading, gzip'd if it starts with
+        parse_demo_file.GZIP_MAGIC
+        - may raise IOError
+        """
+        return open(self.path(name), "rb")
+
+    def remove(self, name):
+        """
+        the caller has to make sure no ReplayFile references name anymore
+        """
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
@@ -16,43 +16,43 @@ class ReplayTable(tables.Table):
     upload_date    = tables.Column()
     uploader       = tables.Column()
     downloads      = tables.Column(accessor="replayfile.download_count", orderable=False)
-    comments       = tables.Column(orderable=False)
+    comments       = tables.Column(accessor="num_comments")
     class Meta:
         attrs    = {'class': 'paleblue'}
         order_by = "-upload_date"
 
 class TagTable(tables.Table):
     name           = tables.LinkColumn('tag_detail', args=[A('name')])
-    replays        = tables.Column(orderable=False)
+    replays        = tables.Column(accessor="num_replays")
     class Meta:
         attrs    = {'class': 'paleblue'}
         order_by = "name"
 
 class MapTable(tables.Table):
     name           = tables.LinkColumn('map_detail', args=[A('name')])
-    replays        = tables.Column(orderable=False)
+    replays        = tables.Column(accessor="num_replays")
     class Meta:
         attrs    = {'class': 'paleblue'}
         order_by = "name"
 
 class PlayerTable(tables.Table):
-    name           = tables.LinkColumn('player_detail', args=[A('accid')])
-    replay_count   = tables.Column(orderable=False)
-    spectator_count= tables.Column(orderable=False)
+    name           = tables.LinkColumn('player_detail', args=[A('account.accountid')])
+    replay_count   = tables.Column()
+    spectator_count= tables.Column()
     class Meta:
         attrs    = {'class': 'paleblue'}
         order_by = "name"
 
 class GameTable(tables.Table):
     name           = tables.LinkColumn('game_detail', args=[A('name')])
-    replays        = tables.Column(orderable=False)
+    replays        = tables.Column()
     class Meta:
         attrs    = {'class': 'paleblue'}
         order_by = "name"
 
 class UserTable(tables.Table):
     username       = tables.LinkColumn('user_detail', args=[A('username')])
-    replays_uploaded = tables.Column(orderable=False)
+    replays_uploaded = tables.Column(accessor="num_uploads")
     class Meta:
         attrs    = {'class': 'paleblue'}
         order_by = "username"
@@ -0,0 +1,118 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# run with "manage.py test srs"
+#
+
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+
+from models import *
+import upload
+import storage
+
+
+class FakeDemofile(object):
+    """
+    the attributes of a parsed demofile that upload.store_replay() uses
+    players: list of dicts with the keys of game_setup['player'] (name and
+             optionally accountid / lobbyid), one team each
+    """
+    def __init__(self, gameID, players):
+        self.sha1 = gameID
+        self.header = {"versionString": "91.0", "gameID": gameID, "wallclockTime": "0:20:00",
+                       "unixTime": "2012-10-01 20:00:00", "winningAllyTeamsSize": 1}
+        self.winningAllyTeams = [0]
+        self.game_setup = {"host": {"mapname": "Tabula v4", "gametype": "Balanced Annihilation V7.72", "startpostype": 1},
+                           "mapoptions": {}, "modoptions": {},
+                           "allyteam": {"0": {"numallies": 0}, "1": {"numallies": 0}},
+                           "player": {}, "team": {}}
+        for num, player in enumerate(players):
+            setup = {"rank": 1, "spectator": 0, "team": num}
+            setup.update(player)
+            self.game_setup["player"][str(num)] = setup
+            self.game_setup["team"][str(num)] = {"allyteam": num % 2, "teamleader": num, "rgbcolor": "0.5 0.5 0.5",
+                                                 "handicap": 0, "side": "ARM"}
+
+class StoreBatchFallbackTest(TransactionTestCase):
+    """
+    import_replays stores the replays of a failed batch one by one, with the
+    same demofile objects (TransactionTestCase: the batch must really be
+    rolled back)
+    """
+    def setUp(self):
+        self.user = User.objects.create(username="importer")
+
+    def store(self, demofile):
+        return upload.store_demofile_data(demofile, "", demofile.sha1+".sdf", demofile.sha1+".sdf", "test", "", self.user)
+
+    def account_of(self, gameID, name):
+        return Player.objects.get(replay__gameID=gameID, name=name).account
+
+    def test_fallback_after_failed_batch(self):
+        # an older replay of "bob" without account
+        self.store(FakeDemofile("a"*32, [{"name": "bob"}, {"name": "eve", "accountid": 7}]))
+        bob_before = self.account_of("a"*32, "bob")
+        last_before = AccountIdSequence.objects.get(pk=1).last
+
+        # "bob" only has a lobbyid: not a reason to unify his older replays
+        first = FakeDemofile("b"*32, [{"name": "alice"}, {"name": "bob", "lobbyid": 500}])
+        second = FakeDemofile("c"*32, [{"name": "carol"}, {"name": "eve", "accountid": 7}])
+        duplicate = FakeDemofile("a"*32, [{"name": "dave"}, {"name": "eve", "accountid": 7}])
+        uploads = [(d, d.sha1+".sdf", d.sha1+".sdf", "test", "") for d in (first, second, duplicate)]
+        self.assertRaises(Exception, upload.store_demofile_batch, uploads, "", self.user)
+        self.assertEqual(AccountIdSequence.objects.get(pk=1).last, last_before)
+        self.assertFalse(Replay.objects.filter(gameID__in=["b"*32, "c"*32]).exists())
+        self.assertFalse("accountid" in first.game_setup["player"]["0"])
+        self.assertFalse("accountid" in first.game_setup["player"]["1"])
+
+        for demofile in (first, second):
+            self.store(demofile)
+        self.assertEqual(AccountIdSequence.objects.get(pk=1).last, last_before-2)
+
+        alice = self.account_of("b"*32, "alice")
+        carol = self.account_of("c"*32, "carol")
+        self.assertEqual(sorted([alice.accountid, carol.accountid]), [last_before-2, last_before-1])
+        self.assertEqual(self.account_of("b"*32, "bob").accountid, 500)
+        self.assertEqual(self.account_of("a"*32, "bob"), bob_before)
+
+        # the next accountless player gets a new account
+        self.store(FakeDemofile("d"*32, [{"name": "dave"}, {"name": "eve", "accountid": 7}]))
+        dave = self.account_of("d"*32, "dave")
+        self.assertEqual(dave.accountid, last_before-3)
+        self.assertEqual(len(set([dave.pk, alice.pk, carol.pk, bob_before.pk])), 4)
+        self.assertEqual(self.account_of("b"*32, "alice").names, "alice")
+
+class ConcurrentDuplicateTest(TransactionTestCase):
+    """
+    an upload of a gameID that was stored after its duplicate check
+    """
+    def setUp(self):
+        self.user = User.objects.create(username="uploader")
+        self.removed = []
+        self.remove = storage.ReplayStorage.remove
+        storage.ReplayStorage.remove = lambda replay_storage, name: self.removed.append(name)
+
+    def tearDown(self):
+        storage.ReplayStorage.remove = self.remove
+
+    def test_duplicate_is_reported(self):
+        (replay, duplicate) = upload.store_uploaded_demofile(FakeDemofile("a"*32, [{"name": "bob"}]), "", "first.sdf", "first.sdf", "test", "", self.user)
+        self.assertEqual(duplicate, None)
+
+        (replay2, duplicate) = upload.store_uploaded_demofile(FakeDemofile("a"*32, [{"name": "bob"}]), "", "second.sdf", "second.sdf", "test", "", self.user)
+        self.assertEqual(replay2, None)
+        self.assertEqual(duplicate, replay)
+        self.assertEqual(self.removed, ["second.sdf"])
+        self.assertEqual(Replay.objects.count(), 1)
+
+        # identical files share the stored one, it is still used
+        (replay2, duplicate) = upload.store_uploaded_demofile(FakeDemofile("a"*32, [{"name": "bob"}]), "", "first.sdf", "first.sdf", "test", "", self.user)
+        self.assertEqual(duplicate, replay)
+        self.assertEqual(self.removed, ["second.sdf"])
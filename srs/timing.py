@@ -0,0 +1,117 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# per-stage timings of the replay ingestion, stored as IngestTiming rows and
+# aggregated into percentiles / histograms for /admin/ingest_stats/ and
+# /ingest_stats.json
+#
+
+import time
+import logging
+import datetime
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+from models import *
+
+logger = logging.getLogger(__package__)
+
+# in order of the pipeline, "upload" and "ingest" are the totals of the
+# upload request and of the background IngestJob
+STAGES = ("receive", "parse", "store_file", "store_db", "upload", "queue", "fetch_info", "fetch_img", "map_img", "ingest")
+PERCENTILES = (50, 90, 95, 99)
+# upper bounds (seconds) of the histogram buckets, the last one is open
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120)
+
+
+class StageTimer(object):
+    """
+    collects the durations of the stages of one ingestion:
+        timer = StageTimer()
+        with timer.stage("parse"):
+            ...
+        timer.total("upload")
+        timer.save(replay)
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.timings = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.time()-start))
+
+    def add(self, name, seconds):
+        self.timings.append((name, seconds))
+
+    def total(self, name):
+        """
+        add the time since the timer was created as stage name
+        """
+        self.add(name, time.time()-self.start)
+
+    def save(self, replay):
+        """
+        store the timings with the replay, errors are only logged
+        """
+        logger.info("replay pk=%d timings: %s", replay.pk, " ".join(["%s=%.3fs" % timing for timing in self.timings]))
+        try:
+            IngestTiming.objects.bulk_create([IngestTiming(replay=replay, stage=stage, seconds=seconds) for stage, seconds in self.timings])
+        except Exception, e:
+            logger.error("Could not save timings of replay pk=%d: %s", replay.pk, e)
+        self.timings = []
+
+def percentile(values, pct):
+    """
+    nearest-rank percentile of the sorted list values
+    """
+    if not values:
+        return None
+    return values[max(int(round(pct/100.0*len(values)))-1, 0)]
+
+def histogram(values):
+    """
+    counts of the sorted list values per bucket of BUCKETS, plus the values
+    above the last one
+    """
+    counts = [0]*(len(BUCKETS)+1)
+    bucket = 0
+    for value in values:
+        while bucket < len(BUCKETS) and value > BUCKETS[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+    return counts
+
+def stats(hours=settings.INGEST_TIMING_HOURS):
+    """
+    percentiles and histogram per stage of the ingestions of the last hours
+    returns [{"stage": .., "count": .., "mean": .., "max": .., "p50": ..,
+    .., "histogram": [..]}, ..] in the order of STAGES
+    """
+    since = timezone.now()-datetime.timedelta(hours=hours)
+    values = dict((stage, []) for stage in STAGES)
+    for stage, seconds in IngestTiming.objects.filter(created__gte=since).values_list("stage", "seconds"):
+        values.setdefault(stage, []).append(seconds)
+    result = []
+    for stage in STAGES+tuple(sorted(set(values.keys())-set(STAGES))):
+        stage_values = sorted(values[stage])
+        stage_stats = {"stage": stage,
+                       "count": len(stage_values),
+                       "mean": sum(stage_values)/len(stage_values) if stage_values else None,
+                       "max": stage_values[-1] if stage_values else None,
+                       "histogram": histogram(stage_values)}
+        for pct in PERCENTILES:
+            stage_stats["p%d" % pct] = percentile(stage_values, pct)
+        result.append(stage_stats)
+    return result
@@ -8,15 +8,19 @@
 
 import logging
 import os
-import shutil
+import base64
+import hashlib
 from tempfile import mkstemp
 import datetime
 
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, HttpResponseRedirect
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotAllowed
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from django.db.models import Min
+from django.db.models import Min, Count, F
+from django.db import connection, transaction, IntegrityError
 import django.contrib.auth
 
 from django_tables2 import RequestConfig
@@ -24,40 +28,104 @@ from django_tables2 import RequestConfig
 from models import *
 from common import all_page_infos
 from forms import UploadFileForm
+import settings
 import parse_demo_file
-import spring_maps
+import demofile_cache
+import storage
+import timing
+import sidebar
+import search
+import ingest
 
 
 logger = logging.getLogger(__package__)
 
+STREAM_CHUNK_SIZE = 64*1024 # bytes read at once from the body of stream_upload()
+
+class DemofileUploadHandler(FileUploadHandler):
+    """
+    checks an uploaded file while it is received: the gameID in its first
+    chunk for a duplicate and its size against settings.UPLOAD_MAX_SIZE
+    Stops the upload before the rest is spooled to disk, the reason is left
+    in error (and the existing Replay in duplicate).
+    """
+    def __init__(self, request=None):
+        super(DemofileUploadHandler, self).__init__(request)
+        self.error = None
+        self.duplicate = None
+        self.received = 0
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None):
+        super(DemofileUploadHandler, self).new_file(field_name, file_name, content_type, content_length, charset)
+        self.received = 0
+        if content_length and content_length > settings.UPLOAD_MAX_SIZE:
+            self.error = "Uploaded file is too big, the limit is %d bytes." % settings.UPLOAD_MAX_SIZE
+            raise StopUpload(connection_reset=True)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.UPLOAD_MAX_SIZE:
+            self.error = "Uploaded file is too big, the limit is %d bytes." % settings.UPLOAD_MAX_SIZE
+            raise StopUpload(connection_reset=True)
+        if start == 0:
+            # the rest of the request is read, but not stored
+            try:
+                self.duplicate = find_duplicate(raw_data)
+            except Exception, e:
+                logger.info("User '%s' uploaded file '%s': %s", self.request.user, self.file_name, e)
+                self.error = "Uploaded file is not a spring demofile."
+                raise StopUpload()
+            if self.duplicate:
+                self.error = 'Uploaded replay already exists: <a href="/replay/%s/">%s</a>'%(self.duplicate.gameID, self.duplicate.__unicode__())
+                raise StopUpload()
+        return raw_data
+
+    def file_complete(self, file_size):
+        # the next handler creates the file
+        return None
+
 @login_required
+@csrf_exempt
 def upload(request):
+    # the handler must be installed before the CSRF check reads request.POST
+    handler = DemofileUploadHandler(request)
+    request.upload_handlers.insert(0, handler)
+    return _upload(request, handler)
+
+@csrf_protect
+def _upload(request, handler):
     c = all_page_infos(request)
     if request.method == 'POST':
         form = UploadFileForm(request.POST, request.FILES)
+        if handler.error:
+            # duplicates, broken and too big files are rejected before they are stored
+            if handler.duplicate:
+                logger.info("Replay already existed: pk=%d gameID=%s", handler.duplicate.pk, handler.duplicate.gameID)
+            return HttpResponse(handler.error)
         if form.is_valid():
+            timer = timing.StageTimer()
             ufile = request.FILES['file']
             short = request.POST['short']
             long_text = request.POST['long_text']
             tags = request.POST['tags']
-            (path, written_bytes) = save_uploaded_file(ufile)
+
+            with timer.stage("receive"):
+                (path, written_bytes) = save_uploaded_file(ufile)
             logger.info("User '%s' uploaded file '%s' with title '%s', parsing it now.", request.user, os.path.basename(path), short[:20])
 #            try:
             if written_bytes != ufile.size:
                 return HttpResponse("Could not store the replay file. Please contact the administrator.")
 
-            demofile = parse_demo_file.Parse_demo_file(path)
-            demofile.check_magic()
-            demofile.parse()
+            with timer.stage("parse"):
+                demofile = demofile_cache.DemofileCache().parse(path)
 
-            try:
-                replay = Replay.objects.get(gameID=demofile.header["gameID"])
-                logger.info("Replay already existed: pk=%d gameID=%s", replay.pk, replay.gameID)
-                return HttpResponse('Uploaded replay already exists: <a href="/replay/%s/">%s</a>'%(replay.gameID, replay.__unicode__()))
-            except:
-                shutil.move(path, settings.MEDIA_ROOT)
-                replay = store_demofile_data(demofile, tags, settings.MEDIA_ROOT+os.path.basename(path), file.name, short, long_text, request.user)
-                logger.info("New replay created: pk=%d gameID=%s", replay.pk, replay.gameID)
+            with timer.stage("store_file"):
+                stored_name = storage.ReplayStorage().store(path, demofile.sha1)
+            (replay, duplicate) = store_uploaded_demofile(demofile, tags, stored_name, ufile.name, short, long_text, request.user, timer)
+            if duplicate:
+                logger.info("Replay already existed: pk=%d gameID=%s", duplicate.pk, duplicate.gameID)
+                return HttpResponse('Uploaded replay already exists: <a href="/replay/%s/">%s</a>'%(duplicate.gameID, duplicate.__unicode__()))
+            logger.info("New replay created: pk=%d gameID=%s", replay.pk, replay.gameID)
             return HttpResponseRedirect(replay.get_absolute_url())
 #            except Exception, e:
 #                return HttpResponse("The was a problem with the upload: %s<br/>Please retry or contact the administrator.<br/><br/><a href="/">Home</a>"%e)
@@ -67,15 +135,148 @@ def upload(request):
     return render_to_response('upload.html', c, context_instance=RequestContext(request))
 
 def xmlrpc_upload(username, password, filename, demofile, subject, comment, tags, owner):
+    timer = timing.StageTimer()
     logger.info("username='%s' password=xxxxxx filename='%s' subject='%s' comment='%s' tags='%s' owner='%s'", username, filename, subject, comment, tags, owner)
 
-    # authenticate uploader
+    (owner_ac, error) = authenticate_uploader(username, password, owner)
+    if error:
+        return error
+
+    # reject duplicates before parsing, the data is parsed directly from
+    # memory and written to disk only if the replay is new
+    data = demofile.data
+    try:
+        replay = find_duplicate(data)
+    except Exception, e:
+        logger.info("Uploaded file '%s': %s", filename, e)
+        return "5 uploaded file is not a spring demofile"
+    if replay:
+        logger.info("Replay already existed: pk=%d gameID=%s", replay.pk, replay.gameID)
+        return '3 uploaded replay already exists as "%s" at "%s"'%(replay.__unicode__(), replay.get_absolute_url())
+
+    with timer.stage("parse"):
+        demofile = demofile_cache.DemofileCache().parse(data=data)
+
+    # this is code double from upload() :(
+    with timer.stage("receive"):
+        (fd, path) = mkstemp(suffix=demofile_ext(filename), prefix=os.path.splitext(filename)[0]+"__")
+        bytes_written = os.write(fd, data)
+        os.close(fd)
+    logger.debug("wrote %d bytes to %s", bytes_written, path)
+
+    return store_upload(demofile, path, bytes_written, filename, subject, comment, tags, owner_ac, timer)
+
+@csrf_exempt
+def stream_upload(request):
+    """
+    upload of a demofile as the raw (may be chunked) body of a POST request,
+    for autohosts, see "xmlrpc_client.py --stream"
+    The body is written to disk while it is received and hashed, duplicates
+    are rejected from its first bytes, bodies larger than
+    settings.UPLOAD_MAX_SIZE when the limit is reached. Credentials of the uploader are
+    expected as HTTP basic auth (WSGIPassAuthorization On for mod_wsgi),
+    the other arguments of xmlrpc_upload() as GET parameters. Returns the
+    same result strings as xmlrpc_upload() as text/plain.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    timer = timing.StageTimer()
+    filename = request.GET.get("filename", "upload.sdf")
+    subject  = request.GET.get("subject", "")
+    comment  = request.GET.get("comment", "")
+    tags     = request.GET.get("tags", "")
+    owner    = request.GET.get("owner", "")
+    logger.info("filename='%s' subject='%s' comment='%s' tags='%s' owner='%s'", filename, subject, comment, tags, owner)
+
+    try:
+        (username, password) = base64.b64decode(request.META["HTTP_AUTHORIZATION"].split(" ", 1)[1]).split(":", 1)
+    except Exception:
+        username = password = None
+    (owner_ac, error) = authenticate_uploader(username, password, owner)
+    if error:
+        return HttpResponse(error, mimetype="text/plain")
+    too_big = "6 file size must be between 1 and %d bytes" % settings.UPLOAD_MAX_SIZE
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > settings.UPLOAD_MAX_SIZE:
+        logger.info("Uploaded file '%s' is too big: %d bytes", filename, content_length)
+        return HttpResponse(too_big, mimetype="text/plain")
+
+    body = iter_request_body(request)
+    # the first chunk is enough to find the gameID, even if gzip'd
+    head = ""
+    for chunk in body:
+        head += chunk
+        if len(head) >= STREAM_CHUNK_SIZE:
+            break
+    try:
+        replay = find_duplicate(head)
+    except Exception, e:
+        logger.info("Uploaded file '%s': %s", filename, e)
+        return HttpResponse("5 uploaded file is not a spring demofile", mimetype="text/plain")
+    if replay:
+        logger.info("Replay already existed: pk=%d gameID=%s", replay.pk, replay.gameID)
+        return HttpResponse('3 uploaded replay already exists as "%s" at "%s"'%(replay.__unicode__(), replay.get_absolute_url()), mimetype="text/plain")
+
+    sha1 = hashlib.sha1(head)
+    with timer.stage("receive"):
+        (fd, path) = mkstemp(suffix=demofile_ext(filename), prefix=os.path.splitext(os.path.basename(filename))[0]+"__")
+        try:
+            try:
+                bytes_written = os.write(fd, head)
+                del head
+                for chunk in body:
+                    if bytes_written+len(chunk) > settings.UPLOAD_MAX_SIZE:
+                        # chunked requests have no Content-Length to check before
+                        raise ValueError("more than %d bytes" % settings.UPLOAD_MAX_SIZE)
+                    sha1.update(chunk)
+                    bytes_written += os.write(fd, chunk)
+            finally:
+                os.close(fd)
+        except ValueError, e:
+            os.remove(path)
+            logger.info("Uploaded file '%s' is too big: %s", filename, e)
+            return HttpResponse(too_big, mimetype="text/plain")
+        except:
+            os.remove(path)
+            raise
+    logger.debug("wrote %d bytes to %s", bytes_written, path)
+
+    try:
+        with timer.stage("parse"):
+            demofile = demofile_cache.DemofileCache().parse(path, digest=sha1.hexdigest())
+    except Exception, e:
+        logger.info("Uploaded file '%s': %s", filename, e)
+        os.remove(path)
+        return HttpResponse("5 uploaded file is not a spring demofile", mimetype="text/plain")
+    return HttpResponse(store_upload(demofile, path, bytes_written, filename, subject, comment, tags, owner_ac, timer), mimetype="text/plain")
+
+def iter_request_body(request, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    yields the body of a request in chunks
+    Django limits reading the body to CONTENT_LENGTH, which is missing for
+    chunked requests - then wsgi.input (dechunked by the server) is read
+    until EOF.
+    """
+    if request.META.get("CONTENT_LENGTH"):
+        stream = request
+    else:
+        stream = request.META["wsgi.input"]
+    for chunk in iter(lambda: stream.read(chunk_size), ""):
+        yield chunk
+
+def authenticate_uploader(username, password, owner):
+    """
+    returns (owner User, None) or (None, result string for the uploader)
+    """
     user = django.contrib.auth.authenticate(username=username, password=password)
     if user is not None and user.is_active:
         logger.info("Authenticated user '%s'", user)
     else:
         logger.info("Uploader woring password, account unknown or inactive, abort.")
-        return "1 Unknown or inactive uploader account or bad password."
+        return (None, "1 Unknown or inactive uploader account or bad password.")
 
     # find owner account
     try:
@@ -83,45 +284,81 @@ def xmlrpc_upload(username, password, filename, demofile, subject, comment, tags
         logger.info("Owner is '%s'", owner_ac)
     except:
         logger.info("Owner '%s' unknown on replays site, abort.", owner)
-        return "2 Unknown or inactive owner account, please log in via web interface once."
+        return (None, "2 Unknown or inactive owner account, please log in via web interface once.")
+    return (owner_ac, None)
 
-    # this is code double from upload() :(
-    (fd, path) = mkstemp(suffix=".sdf", prefix=filename[:-4]+"__")
-    bytes_written = os.write(fd, demofile.data)
-    logger.debug("wrote %d bytes to /tmp/%s", bytes_written, filename)
+def store_upload(demofile, path, bytes_written, filename, subject, comment, tags, owner_ac, timer=None):
+    """
+    moves the uploaded file at path to the ReplayStorage and stores the
+    replay, returns the result string for the uploader
+    timer: timing.StageTimer of the upload
+    """
+    timer = timer or timing.StageTimer()
+    try:
+        with timer.stage("store_file"):
+            stored_name = storage.ReplayStorage().store(path, demofile.sha1)
+        (replay, duplicate) = store_uploaded_demofile(demofile, tags, stored_name, filename, subject, comment, owner_ac, timer)
+    except Exception, e:
+        logger.error("Error in store_demofile_data(): %s", e)
+        return "4 server error, please try again later, or contact admin"
+    if duplicate:
+        logger.info("Replay already existed: pk=%d gameID=%s", duplicate.pk, duplicate.gameID)
+        return '3 uploaded replay already exists as "%s" at "%s"'%(duplicate.__unicode__(), duplicate.get_absolute_url())
 
-    demofile = parse_demo_file.Parse_demo_file(path)
-    demofile.check_magic()
-    demofile.parse()
+    logger.info("New replay created: pk=%d gameID=%s", replay.pk, replay.gameID)
+    if settings.INGEST_ASYNC:
+        return '0 received %d bytes, replay at "%s" (processing)'%(bytes_written, replay.get_absolute_url())
+    elif replay.ingestjob.status == IngestJob.FAILED:
+        return '0 received %d bytes, replay at "%s" (without map infos: %s)'%(bytes_written, replay.get_absolute_url(), replay.ingestjob.error)
+    else:
+        return '0 received %d bytes, replay at "%s"'%(bytes_written, replay.get_absolute_url())
 
+def store_uploaded_demofile(demofile, tags, stored_name, filename, short, long_text, user, timer=None):
+    """
+    store_demofile_data() for an upload already moved to the ReplayStorage
+    If it fails, the file is removed from the storage again (unless a
+    ReplayFile references it, the storage keeps identical files once).
+    returns (Replay, None), or (None, existing Replay) if the same gameID was
+    stored concurrently
+    - may raise Exception
+    """
     try:
-        replay = Replay.objects.get(gameID=demofile.header["gameID"])
-        logger.info("Replay already existed: pk=%d gameID=%s", replay.pk, replay.gameID)
+        return (store_demofile_data(demofile, tags, stored_name, filename, short, long_text, user, timer), None)
+    except Exception, e:
+        if not ReplayFile.objects.filter(filename=stored_name).exists():
+            storage.ReplayStorage().remove(stored_name)
+        # the unique gameID fails the insert of a concurrent duplicate
         try:
-            os.remove(path)
-        except:
-            logger.error("Could not remove file '%s'", path)
-        return '3 uploaded replay already exists as "%s" at "%s"'%(replay.__unicode__(), replay.get_absolute_url())
-    except:
-        pass
+            return (None, Replay.objects.get(gameID=demofile.header["gameID"]))
+        except Replay.DoesNotExist:
+            raise e
 
-    shutil.move(path, settings.MEDIA_ROOT)
+def find_duplicate(data):
+    """
+    returns the Replay with the gameID from the first bytes of an uploaded
+    demo (at least 296 bytes or a gzip'd chunk covering them) or None
+    - may raise Exception when data is not a spring demofile
+    """
+    gameID = parse_demo_file.sniff_game_id(data)
     try:
-        replay = store_demofile_data(demofile, tags, settings.MEDIA_ROOT+os.path.basename(path), filename, subject, comment, user)
-        replay.uploader = owner_ac
-        replay.save()
-    except Exception, e:
-        logger.error("Error in store_demofile_data(): %s", e)
-        return "4 server error, please try again later, or contact admin"
+        return Replay.objects.get(gameID=gameID)
+    except Replay.DoesNotExist:
+        return None
 
-    logger.info("New replay created: pk=%d gameID=%s", replay.pk, replay.gameID)
-    return '0 received %d bytes, replay at "%s"'%(bytes_written, replay.get_absolute_url())
+def demofile_ext(filename):
+    """
+    keep the extension of gzip compressed demos, so they are served as such
+    """
+    if filename.lower().endswith(".sdfz"):
+        return ".sdfz"
+    else:
+        return ".sdf"
 
 def save_uploaded_file(ufile):
     """
     may raise an exception from os.open/write/close()
     """
-    (fd, path) = mkstemp(suffix=".sdf", prefix=ufile.name[:-4]+"__")
+    (fd, path) = mkstemp(suffix=demofile_ext(ufile.name), prefix=os.path.splitext(ufile.name)[0]+"__")
     written_bytes = 0
     for chunk in ufile.chunks():
         written_bytes += os.write(fd, chunk)
@@ -129,146 +366,164 @@ def save_uploaded_file(ufile):
     logger.debug("stored file with '%d' bytes in '%s'", written_bytes, path)
     return (path, written_bytes)
 
-def store_demofile_data(demofile, tags, path, filename, short, long_text, user):
+def store_demofile_data(demofile, tags, stored_name, filename, short, long_text, user, timer=None):
     """
     Store all data about this replay in the database
+    Everything is written in one transaction with bulk inserts, so nothing
+    is left behind if it fails. Fetching map infos and rendering the map
+    image is done by an IngestJob, in the background if
+    settings.INGEST_ASYNC is set.
+    stored_name: name of the demofile in the ReplayStorage
+    timer: timing.StageTimer of the upload, its timings are saved with the
+           replay
     """
+    check_supported(demofile)
+
+    timer = timer or timing.StageTimer()
+    with timer.stage("store_db"):
+        replay = _store_demofile_data(demofile, tags, stored_name, filename, short, long_text, user)
+    timer.total("upload")
+    timer.save(replay)
+    sidebar.invalidate("replay pk=%d stored" % replay.pk)
+
+    if not settings.INGEST_ASYNC:
+        ingest.process_job(replay.ingestjob, retry=False)
+    return replay
+
+def store_demofile_batch(uploads, tags, user):
+    """
+    Store many replays (for imports) in one transaction, tags and map infos
+    are looked up once for all of them.
+    uploads: list of (demofile, stored_name, filename, short, long_text)
+    returns the list of Replays
+    - may raise Exception, nothing of the batch is stored then
+    """
+    for upload in uploads:
+        check_supported(upload[0])
+
+    replays = _store_demofile_batch(uploads, tags, user)
+    sidebar.invalidate("%d replays imported" % len(replays))
+
+    if not settings.INGEST_ASYNC:
+        for replay in replays:
+            ingest.process_job(replay.ingestjob, retry=False)
+    return replays
+
+def check_supported(demofile):
+    """
+    - may raise Exception if the replay can not be stored
+    """
+    startpostype = demofile.game_setup["host"]["startpostype"]
+    if startpostype not in [1, 2]:
+        #TODO:
+        logger.debug("gameID=%s startpostype=%s not yet supported", demofile.header["gameID"], startpostype)
+        raise Exception("startpostype not yet supported, pls report this to dansan at the forums and include replay file")
+
+@transaction.commit_on_success
+def _store_demofile_data(demofile, tags, stored_name, filename, short, long_text, user):
+    return store_replay(demofile, get_tags(tags), stored_name, filename, short, long_text, user)
+
+@transaction.commit_on_success
+def _store_demofile_batch(uploads, tags, user):
+    tag_objs = get_tags(tags)
+    mapnames = set(demofile.game_setup["host"]["mapname"] for demofile, _, _, _, _ in uploads)
+    map_infos = {}
+    for smap in Map.objects.filter(name__in=mapnames).order_by("-pk"):
+        map_infos[smap.name] = smap
+    return [store_replay(demofile, tag_objs, stored_name, filename, short, long_text, user, map_infos) for demofile, stored_name, filename, short, long_text in uploads]
+
+def store_replay(demofile, tag_objs, stored_name, filename, short, long_text, user, map_infos=None):
+    """
+    the inserts of one replay, the caller handles the transaction
+    tag_objs: Tags from get_tags(), the autotag is added
+    map_infos: {mapname: Map} if already looked up, else the Map is queried
+    """
+    game_setup = demofile.game_setup
+    mapname = game_setup["host"]["mapname"]
+
+    # only AllyTeams that have Teams are saved (works around Zero-Ks usage
+    # of useless AllyTeams)
+    teams_per_allyteam = {}
+    for team in game_setup['team'].values():
+        num = str(team["allyteam"])
+        teams_per_allyteam[num] = teams_per_allyteam.get(num, 0) + 1
+    allyteam_nums = sorted([num for num in game_setup['allyteam'].keys() if num in teams_per_allyteam], key=int)
+    autotag = make_autotag([teams_per_allyteam[num] for num in allyteam_nums])
+
     replay = Replay()
     replay.uploader = user
 
-    # copy match infos 
+    # copy match infos
     for key in ["versionString", "gameID", "wallclockTime"]:
         replay.__setattr__(key, demofile.header[key])
     replay.unixTime = datetime.datetime.strptime(demofile.header["unixTime"], "%Y-%m-%d %H:%M:%S")
-    for key in ["mapname", "autohostname", "gametype", "startpostype"]:
-        if demofile.game_setup["host"].has_key(key):
-            replay.__setattr__(key, demofile.game_setup["host"][key])
+    for key in ["autohostname", "gametype", "startpostype"]:
+        if game_setup["host"].has_key(key):
+            replay.__setattr__(key, game_setup["host"][key])
+    # winner known?
+    replay.notcomplete = demofile.header['winningAllyTeamsSize'] == 0
+    # map infos are fetched by the IngestJob if the map is new
+    if map_infos is None:
+        map_infos = dict((smap.name, smap) for smap in Map.objects.filter(name=mapname).order_by("pk")[:1])
+    replay.map_info = map_infos.get(mapname)
+    save_desc(replay, short, long_text, autotag)
 
     # the replay file
-    replay.replayfile = ReplayFile.objects.create(filename=os.path.basename(path), path=os.path.dirname(path), ori_filename=filename, download_count=0)
+    replay.replayfile = ReplayFile.objects.create(filename=stored_name, path=settings.MEDIA_ROOT, ori_filename=filename, download_count=0)
 
     replay.save()
 
     logger.debug("replay pk=%d gameID=%s unixTime=%s created", replay.pk, replay.gameID, replay.unixTime)
 
     # save AllyTeams
-    allyteams = {}
-    for num,val in demofile.game_setup['allyteam'].items():
+    new_allyteams = []
+    for num in allyteam_nums:
         allyteam = Allyteam()
-        allyteams[num] = allyteam
-        for k,v in val.items():
+        for k,v in game_setup['allyteam'][num].items():
             allyteam.__setattr__(k, v)
         allyteam.replay = replay
         allyteam.winner = int(num) in demofile.winningAllyTeams
-        allyteam.save()
+        new_allyteams.append(allyteam)
+    Allyteam.objects.bulk_create(new_allyteams)
+    # bulk_create() doesn't set the pks, rows are inserted in list order
+    allyteams = dict(zip(allyteam_nums, Allyteam.objects.filter(replay=replay).order_by("pk")))
 
     logger.debug("replay pk=%d allyteams=%s", replay.pk, [a.pk for a in allyteams.values()])
 
-    # winner known?
-    replay.notcomplete = demofile.header['winningAllyTeamsSize'] == 0
-
-    # get / create map infos
-    try:
-        replay.map_info = Map.objects.get(name=demofile.game_setup["host"]["mapname"])
-        logger.debug("replay pk=%d using existing map_info.pk=%d", replay.pk, replay.map_info.pk)
-    except:
-        # 1st time upload for this map: fetch info and full map, create thumb
-        # for index page
-        smap = spring_maps.Spring_maps(demofile.game_setup["host"]["mapname"])
-        smap.fetch_info()
-        startpos = ""
-        for coord in smap.map_info[0]["metadata"]["StartPos"]:
-            startpos += "%f,%f|"%(coord["x"], coord["z"])
-        startpos = startpos[:-1]
-        replay.map_info = Map.objects.create(name=demofile.game_setup["host"]["mapname"], startpos=startpos, height=smap.map_info[0]["metadata"]["Height"], width=smap.map_info[0]["metadata"]["Width"])
-
-        full_img = smap.fetch_img()
-        MapImg.objects.create(filename=full_img, startpostype=-1, map_info=replay.map_info)
-        smap.make_home_thumb()
-        logger.debug("replay pk=%d created new map_info and MapImg: map_info.pk=%d", replay.pk, replay.map_info.pk)
-
-    # get / create map thumbs
-    logger.debug("replay pk=%d startpostype=%d", replay.pk, demofile.game_setup["host"]["startpostype"])
-    if demofile.game_setup["host"]["startpostype"] == 1:
-        # fixed start positions before game
-        try:
-            replay.map_img = MapImg.objects.get(map_info = replay.map_info, startpostype=1)
-            logger.debug("replay pk=%d using existing map_img.pk=%d", replay.pk, replay.map_img.pk)
-        except:
-            mapfile = spring_maps.create_map_with_positions(replay.map_info)
-            replay.map_img = MapImg.objects.create(filename=mapfile, startpostype=1, map_info=replay.map_info)
-            logger.debug("replay pk=%d created new map_img.pk=%d", replay.pk, replay.map_img.pk)
-    elif demofile.game_setup["host"]["startpostype"] == 2:
-        # start boxes
-        mapfile = spring_maps.create_map_with_boxes(replay)
-        replay.map_img = MapImg.objects.create(filename=mapfile, startpostype=2, map_info=replay.map_info)
-        logger.debug("replay pk=%d created new map_img.pk=%d", replay.pk, replay.map_img.pk)
-    else:
-        #TODO:
-        logger.debug("replay pk=%d startpostype not yet supported", replay.pk)
-        raise Exception("startpostype not yet supported, pls report this to dansan at the forums and include replay file")
-
-    replay.save()
-
     # save tags
-    save_tags(replay, tags)
-    replay.save()
+    tag_objs = tag_objs+[Tag.objects.get_or_create(name=autotag, defaults={'name': autotag})[0]]
+    replay.tags.add(*tag_objs)
 
     # save map and mod options
-    for k,v in demofile.game_setup['mapoptions'].items():
-        MapOption.objects.create(name=k, value=v, replay=replay)
-
-    for k,v in demofile.game_setup['modoptions'].items():
-        ModOption.objects.create(name=k, value=v, replay=replay)
+    options = [MapModOption(name=k, value=v, replay=replay) for k,v in game_setup['mapoptions'].items()]
+    options.extend([MapModOption(name=k, value=v, replay=replay) for k,v in game_setup['modoptions'].items()])
+    if options:
+        MapModOption.objects.bulk_create(options)
+        option_pks = list(MapModOption.objects.filter(replay=replay).order_by("pk").values_list("pk", flat=True))
+        num_mapoptions = len(game_setup['mapoptions'])
+        bulk_insert_children(MapOption, option_pks[:num_mapoptions])
+        bulk_insert_children(ModOption, option_pks[num_mapoptions:])
 
     logger.debug("replay pk=%d added tags, mapoptions and modoptions", replay.pk)
 
     # save players and their accounts
-    players = {}
-    teams = {}
-    for k,v in demofile.game_setup['player'].items():
-        pac = Player.objects.none()
-        if v.has_key("accountid"):
-            # check if we have a Player that was missing an accountid previously
-            pac = Player.objects.filter(name=v["name"], account__accountid__lt=0)
-        else:
-            # single player - we still need a unique accountid. I make it
-            # negative, so if the same Player pops up in another replay, and has
-            # a proper accountid, it can be noticed and corrected
-            min_acc_id = PlayerAccount.objects.aggregate(Min("accountid"))['accountid__min']
-            if not min_acc_id or min_acc_id > 0: min_acc_id = 0
-            v["accountid"] = min_acc_id-1
-        if v.has_key("lobbyid"):
-            # game was on springie
-            v["accountid"] = v["lobbyid"]
-        pa, created = PlayerAccount.objects.get_or_create(accountid=v["accountid"], defaults={'accountid': v["accountid"], 'countrycode': v["countrycode"], 'names': v["name"]})
-        logger.debug("replay pk=%d PlayerAccount: created=%s pa.pk=%d pa.accountid=%d pa.names=%s", replay.pk, created, pa.pk, pa.accountid, pa.names)
-        players[k] = Player.objects.create(account=pa, name=v["name"], rank=v["rank"], spectator=bool(v["spectator"]), replay=replay)
-        logger.debug("replay pk=%d created Player: account=%d name=%s spectator=%s", replay.pk, pa.accountid, players[k].name, players[k].spectator)
-        if not created:
-            # add players name to accounts aliases
-            if v["name"] not in pa.names.split(";"):
-                pa.names += ";"+v["name"]
-                pa.save()
-        if pa.accountid > 0:
-            # if we found players w/o account, and now have a player with the
-            # same name, but with an account - unify them
-            if pac:
-                logger.info("replay pk=%d found matching name-account info for previously accountless player(s):", replay.pk)
-                logger.info("replay pk=%d PA.pk=%d Player(s).pk:%s", replay.pk, pa.pk, [(p.name, p.pk) for p in pac])
-            for player in pac:
-                old_ac = player.account
-                player.account = pa
-                player.save
-                old_ac.delete()
-        if v.has_key("team"):
-            teams[str(v["team"])] = players[k]
+    player_nums = sorted(game_setup['player'].keys(), key=int)
+    player_setups = [game_setup['player'][k] for k in player_nums]
+    accounts = resolve_accounts(player_setups)
+    new_players = []
+    for v, pa in zip(player_setups, accounts):
+        new_players.append(Player(account=pa, name=v["name"], rank=v["rank"], spectator=bool(v["spectator"]), replay=replay))
+    Player.objects.bulk_create(new_players)
+    players = dict(zip(player_nums, Player.objects.filter(replay=replay).order_by("pk")))
+    add_replay_counts([(pa.pk, v["spectator"]) for v, pa in zip(player_setups, accounts)])
     logger.debug("replay pk=%d saved Players and PlayerAccounts", replay.pk,)
 
     # save teams
-    for num,val in demofile.game_setup['team'].items():
+    team_nums = sorted(game_setup['team'].keys(), key=int)
+    new_teams = []
+    for num in team_nums:
         team = Team()
-        for k,v in val.items():
+        for k,v in game_setup['team'][num].items():
             if k == "allyteam":
                 team.allyteam = allyteams[str(v)]
             elif k == "teamleader":
@@ -278,46 +533,223 @@ def store_demofile_data(demofile, tags, path, filename, short, long_text, user):
             else:
                 team.__setattr__(k, v)
         team.replay = replay
-        team.save()
-
-        teams[num].team = team # Player.team
-        teams[num].save()
+        new_teams.append(team)
+    Team.objects.bulk_create(new_teams)
+    teams = dict(zip(team_nums, Team.objects.filter(replay=replay).order_by("pk")))
+
+    # Player.team
+    player_teams = {}
+    for k,v in game_setup['player'].items():
+        if v.has_key("team") and str(v["team"]) in teams:
+            player_teams[players[k].pk] = teams[str(v["team"])].pk
+    bulk_update(Player, "team", player_teams)
     logger.debug("replay pk=%d saved Teams", replay.pk)
 
-    # work around Zero-Ks usage of useless AllyTeams
-    ats = Allyteam.objects.filter(replay=replay, team__isnull=True)
-    logger.debug("replay pk=%d deleting useless AllyTeams:%s", replay.pk, ats)
-    ats.delete()
+    # map infos and image
+    replay.ingestjob = IngestJob.objects.create(replay=replay, mapname=mapname, progress="queued")
+    logger.debug("replay pk=%d queued IngestJob pk=%d", replay.pk, replay.ingestjob.pk)
 
-    # auto add tag 1v1 2v2 etc.
-    autotag = set_autotag(replay)
+    search.index_replay(replay, mapname, [tag.name for tag in tag_objs], [v["name"] for v in player_setups]+[pa.names for pa in accounts])
 
     # TODO: SP and bot detection
 
-    # save descriptions
-    save_desc(replay, short, long_text, autotag)
-
-    replay.save()
     logger.debug("replay pk=%d autotag='%s', title='%s'", replay.pk, autotag, replay.title)
 
     return replay
 
-def save_tags(replay, tags):
+def bulk_insert_children(model, parent_pks):
+    """
+    insert the rows of a multi-table inheritance child model (bulk_create()
+    refuses those) for already existing parent rows, in one query
+    """
+    if not parent_pks:
+        return
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s) VALUES %s" % (qn(model._meta.db_table), qn(model._meta.pk.column), ", ".join(["(%s)"]*len(parent_pks)))
+    connection.cursor().execute(sql, parent_pks)
+
+def bulk_update(model, fieldname, values):
+    """
+    set a field (column, for foreign keys the pk) to a different value for
+    each row in one query
+    values: {pk: value, ..}
+    """
+    if not values:
+        return
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+    sql = "UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+        qn(model._meta.db_table), qn(model._meta.get_field(fieldname).column), pk_column,
+        " ".join(["WHEN %s THEN %s"]*len(values)), pk_column, ", ".join(["%s"]*len(values)))
+    params = []
+    for pk, value in values.items():
+        params.extend([pk, value])
+    params.extend(values.keys())
+    connection.cursor().execute(sql, params)
+
+def allocate_negative_accountids(num):
+    """
+    returns num unused negative accountids from the AccountIdSequence
+    The row stays locked until the transaction ends, so concurrent uploads
+    cannot get the same ids.
+    """
+    if not AccountIdSequence.objects.filter(pk=1).update(last=F("last")-num):
+        # 1st use: start below the existing accounts
+        min_acc_id = PlayerAccount.objects.aggregate(Min("accountid"))['accountid__min']
+        if not min_acc_id or min_acc_id > 0: min_acc_id = 0
+        sid = transaction.savepoint()
+        try:
+            AccountIdSequence.objects.create(pk=1, last=min_acc_id)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # created concurrently
+            transaction.savepoint_rollback(sid)
+        AccountIdSequence.objects.filter(pk=1).update(last=F("last")-num)
+    last = AccountIdSequence.objects.get(pk=1).last
+    return range(last+num-1, last-1, -1)
+
+def resolve_accounts(players):
+    """
+    get / create the PlayerAccounts of a replays players in a constant
+    number of queries
+    players: list of dicts from game_setup['player'], they are not modified
+             (the import retries failed batches with the same dicts)
+    returns a list with the PlayerAccount of each player
+    """
+    # single player - we still need a unique accountid. I make it negative,
+    # so if the same Player pops up in another replay, and has a proper
+    # accountid, it can be noticed and corrected
+    num_accountless = len([v for v in players if not v.has_key("accountid") and not v.has_key("lobbyid")])
+    negative_ids = iter(allocate_negative_accountids(num_accountless) if num_accountless else [])
+    accountids = []
+    for v in players:
+        if v.has_key("lobbyid"):
+            # game was on springie
+            accountids.append(v["lobbyid"])
+        elif v.has_key("accountid"):
+            accountids.append(v["accountid"])
+        else:
+            accountids.append(negative_ids.next())
+
+    accounts = dict((pa.accountid, pa) for pa in PlayerAccount.objects.filter(accountid__in=set(accountids)))
+    new_accounts = {}
+    for v, accountid in zip(players, accountids):
+        if accountid not in accounts and accountid not in new_accounts:
+            new_accounts[accountid] = PlayerAccount(accountid=accountid, countrycode=v.get("countrycode", ""), names=v["name"])
+    new_aliases = []
+    if new_accounts:
+        PlayerAccount.objects.bulk_create(new_accounts.values())
+        accounts.update((pa.accountid, pa) for pa in PlayerAccount.objects.filter(accountid__in=new_accounts.keys()))
+        new_aliases.extend([PlayerAlias(account=accounts[accountid], name=accounts[accountid].names) for accountid in new_accounts.keys()])
+    logger.debug("PlayerAccounts: existing=%d created=%d", len(accounts)-len(new_accounts), len(new_accounts))
+
+    # add players names to accounts aliases
+    names = {}
+    for v, accountid in zip(players, accountids):
+        pa = accounts[accountid]
+        if v["name"] not in pa.names.split(";"):
+            pa.names += ";"+v["name"]
+            names[pa.pk] = pa.names
+            new_aliases.append(PlayerAlias(account=pa, name=v["name"], replay_count=pa.replay_count, spectator_count=pa.spectator_count))
+    bulk_update(PlayerAccount, "names", names)
+    PlayerAlias.objects.bulk_create(new_aliases)
+
+    # if we find players w/o account, and now have a player with the same
+    # name, but with an account - unify them
+    unify = dict((v["name"], accounts[accountid]) for v, accountid in zip(players, accountids) if v.has_key("accountid") and accountid > 0)
+    if unify:
+        moved = {}
+        old_accounts = set()
+        moved_players = []
+        for pk, name, account_pk, spectator in Player.objects.filter(name__in=unify.keys(), account__accountid__lt=0).values_list("pk", "name", "account", "spectator"):
+            moved[pk] = unify[name].pk
+            old_accounts.add(account_pk)
+            moved_players.append((unify[name].pk, spectator))
+        if moved:
+            logger.info("found matching name-account info for previously accountless player(s): %s", [(name, unify[name].pk) for name in set(unify.keys())])
+            bulk_update(Player, "account", moved)
+            add_replay_counts(moved_players)
+            PlayerAccount.objects.filter(pk__in=old_accounts).exclude(pk__in=[pa.pk for pa in accounts.values()]).delete()
+
+    return [accounts[accountid] for accountid in accountids]
+
+def add_replay_counts(players):
+    """
+    increment the counters of PlayerAccounts and their PlayerAliases for
+    new Player rows, with one query per table and distinct increment
+    (usually two: players and spectators)
+    players: list of (account pk, spectator)
+    """
+    increments = {}
+    for pk, spectator in players:
+        (replays, spectated) = increments.get(pk, (0, 0))
+        increments[pk] = (replays+1, spectated+int(bool(spectator)))
+    pks_by_increment = {}
+    for pk, increment in increments.items():
+        pks_by_increment.setdefault(increment, []).append(pk)
+    for (replays, spectated), pks in pks_by_increment.items():
+        PlayerAccount.objects.filter(pk__in=pks).update(replay_count=F("replay_count")+replays, spectator_count=F("spectator_count")+spectated,
+                                                        game_count=F("game_count")+(replays-spectated))
+        PlayerAlias.objects.filter(account__in=pks).update(replay_count=F("replay_count")+replays, spectator_count=F("spectator_count")+spectated)
+
+def recount_games():
+    """
+    set the counters of the PlayerAccounts from the Player rows and rebuild
+    the PlayerAliases from PlayerAccount.names
+    """
+    qn = connection.ops.quote_name
+    pa_table = qn(PlayerAccount._meta.db_table)
+    pa_column = lambda name: qn(PlayerAccount._meta.get_field(name).column)
+    player_table = qn(Player._meta.db_table)
+    count_sql = "(SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s%%s)" % (player_table, player_table, qn(Player._meta.get_field("account").column),
+                                                                 pa_table, qn(PlayerAccount._meta.pk.column))
+    spectator_sql = " AND %s.%s = %%s" % (player_table, qn(Player._meta.get_field("spectator").column))
+    cursor = connection.cursor()
+    cursor.execute("UPDATE %s SET %s = %s, %s = %s" % (pa_table, pa_column("replay_count"), count_sql % "", pa_column("spectator_count"), count_sql % spectator_sql), [True])
+    cursor.execute("UPDATE %s SET %s = %s - %s" % (pa_table, pa_column("game_count"), pa_column("replay_count"), pa_column("spectator_count")))
+
+    PlayerAlias.objects.all().delete()
+    aliases = []
+    for pk, names, replay_count, spectator_count in PlayerAccount.objects.values_list("pk", "names", "replay_count", "spectator_count").iterator():
+        for name in set(names.split(";")):
+            aliases.append(PlayerAlias(account_id=pk, name=name, replay_count=replay_count, spectator_count=spectator_count))
+        if len(aliases) >= 1000:
+            PlayerAlias.objects.bulk_create(aliases)
+            aliases = []
+    PlayerAlias.objects.bulk_create(aliases)
+    transaction.commit_unless_managed()
+    sidebar.invalidate("game counts recalculated")
+
+def get_tags(tags):
+    """
+    returns the Tag objects for a string of comma separated tags, missing
+    ones are created
+    """
+    tag_objs = []
     if tags:
         # strip comma separated tags and remove empty ones
         tags_ = [t.strip() for t in tags.split(",") if t.strip()]
         for tag in tags_:
             t_obj, _ = Tag.objects.get_or_create(name__iexact = tag, defaults={'name': tag})
-            replay.tags.add(t_obj)
+            tag_objs.append(t_obj)
+    return tag_objs
 
-def set_autotag(replay):
-    autotag = ""
-    if Allyteam.objects.filter(replay=replay).count() > 3:
-        autotag = "FFA"
+def save_tags(replay, tags):
+    tag_objs = get_tags(tags)
+    if tag_objs:
+        replay.tags.add(*tag_objs)
+
+def make_autotag(teams_per_allyteam):
+    """
+    "FFA" or "1v1", "2v2" etc from the number of teams in each allyteam
+    """
+    if len(teams_per_allyteam) > 3:
+        return "FFA"
     else:
-        for at in Allyteam.objects.filter(replay=replay):
-            autotag += str(Team.objects.filter(allyteam=at).count())+"v"
-        autotag = autotag[:-1]
+        return "v".join([str(num) for num in teams_per_allyteam])
+
+def set_autotag(replay):
+    autotag = make_autotag([at.num_teams for at in Allyteam.objects.filter(replay=replay).annotate(num_teams=Count("team")).order_by("pk")])
 
     tag, created = Tag.objects.get_or_create(name = autotag, defaults={'name': autotag})
     if created:
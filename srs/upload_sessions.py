@@ -0,0 +1,188 @@
+# This file is part of the "spring relay site / srs" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2012 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# resumable uploads for autohosts on bad connections (see "xmlrpc_client.py
+# --resumable"): xmlrpc_upload_begin() returns a session token, the file is
+# sent in numbered chunks with xmlrpc_upload_chunk() (in any order, again if
+# lost), xmlrpc_upload_status() lists the received chunks and
+# xmlrpc_upload_commit() assembles the file, checks its SHA1 and stores the
+# replay like xmlrpc_upload(). Only begin needs the credentials, the token is
+# the secret for the other calls.
+#
+
+import os
+import uuid
+import shutil
+import hashlib
+import logging
+import datetime
+from tempfile import mkstemp
+
+from django.utils import timezone
+
+from models import *
+import upload
+import demofile_cache
+import timing
+
+logger = logging.getLogger(__package__)
+
+
+def session_path(session, num=None):
+    path = os.path.join(settings.UPLOAD_SESSION_PATH, session.token)
+    if num is None:
+        return path
+    return os.path.join(path, "%d" % num)
+
+def get_session(token):
+    try:
+        return UploadSession.objects.get(token=token)
+    except UploadSession.DoesNotExist:
+        logger.info("Unknown upload session '%s'", token)
+        return None
+
+def remove_session(session):
+    shutil.rmtree(session_path(session), ignore_errors=True)
+    session.delete()
+
+def remove_expired_sessions():
+    limit = timezone.now()-datetime.timedelta(seconds=settings.UPLOAD_SESSION_TIMEOUT)
+    for session in UploadSession.objects.filter(updated__lt=limit):
+        logger.info("Removing expired upload session %s", session)
+        remove_session(session)
+
+def received_chunks(session):
+    """
+    numbers of the chunks on disk
+    """
+    try:
+        return sorted([int(num) for num in os.listdir(session_path(session)) if num.isdigit()])
+    except OSError:
+        return []
+
+def xmlrpc_upload_begin(username, password, filename, size, chunk_size, subject, comment, tags, owner):
+    """
+    returns "0 <token>" or an error string like xmlrpc_upload()
+    """
+    logger.info("username='%s' password=xxxxxx filename='%s' size=%d chunk_size=%d subject='%s' comment='%s' tags='%s' owner='%s'", username, filename, size, chunk_size, subject, comment, tags, owner)
+
+    (owner_ac, error) = upload.authenticate_uploader(username, password, owner)
+    if error:
+        return error
+    if not 0 < size <= settings.UPLOAD_MAX_SIZE:
+        return "6 file size must be between 1 and %d bytes" % settings.UPLOAD_MAX_SIZE
+    if not settings.UPLOAD_CHUNK_SIZES[0] <= chunk_size <= settings.UPLOAD_CHUNK_SIZES[1]:
+        return "6 chunk size must be between %d and %d bytes" % settings.UPLOAD_CHUNK_SIZES
+
+    remove_expired_sessions()
+    user = User.objects.get(username__iexact=username)
+    session = UploadSession.objects.create(token=uuid.uuid4().hex, uploader=user, owner=owner_ac, filename=os.path.basename(filename), subject=subject,
+                                           comment=comment, tags=tags, size=size, chunk_size=chunk_size)
+    os.makedirs(session_path(session))
+    logger.info("Upload session %s for %d chunks started", session.token, session.num_chunks())
+    return "0 %s" % session.token
+
+def xmlrpc_upload_chunk(token, num, data):
+    """
+    store chunk num (xmlrpclib.Binary) of an upload session, all but the
+    last chunk must have the sessions chunk_size
+    returns "0 received chunk <num>" or an error string
+    """
+    session = get_session(token)
+    if not session or session.status != UploadSession.OPEN:
+        return "7 unknown or finished upload session"
+    data = data.data
+    last = session.num_chunks()-1
+    expected = session.size-last*session.chunk_size if num == last else session.chunk_size
+    if not 0 <= num <= last or len(data) != expected:
+        return "6 chunk %d must have %d bytes" % (num, expected)
+
+    if num == 0:
+        # reject duplicates before the rest is sent
+        try:
+            replay = upload.find_duplicate(data)
+        except Exception, e:
+            logger.info("Upload session %s: %s", token, e)
+            remove_session(session)
+            return "5 uploaded file is not a spring demofile"
+        if replay:
+            logger.info("Replay already existed: pk=%d gameID=%s", replay.pk, replay.gameID)
+            remove_session(session)
+            return '3 uploaded replay already exists as "%s" at "%s"'%(replay.__unicode__(), replay.get_absolute_url())
+
+    # write atomically, a chunk file is complete or missing
+    (fd, tmp_path) = mkstemp(dir=session_path(session), prefix=".tmp")
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, session_path(session, num))
+    UploadSession.objects.filter(pk=session.pk).update(updated=timezone.now())
+    return "0 received chunk %d" % num
+
+def xmlrpc_upload_status(token):
+    """
+    returns "0 <comma separated numbers of the received chunks>" or an
+    error string
+    """
+    session = get_session(token)
+    if not session:
+        return "7 unknown or finished upload session"
+    return "0 %s" % ",".join([str(num) for num in received_chunks(session)])
+
+def xmlrpc_upload_commit(token, sha1):
+    """
+    assemble the chunks, check them against the SHA1 hexdigest of the whole
+    file and store the replay
+    returns the result string of the upload (again, if called repeatedly)
+    """
+    session = get_session(token)
+    if not session:
+        return "7 unknown or finished upload session"
+    if not UploadSession.objects.filter(pk=session.pk, status=UploadSession.OPEN).update(status=UploadSession.COMMITTING, updated=timezone.now()):
+        session = get_session(token)
+        if session and session.status == UploadSession.DONE:
+            return session.result
+        return "8 upload session is being committed, ask again later"
+
+    missing = set(range(session.num_chunks()))-set(received_chunks(session))
+    if missing:
+        UploadSession.objects.filter(pk=session.pk).update(status=UploadSession.OPEN)
+        return "6 missing chunks: %s" % ",".join([str(num) for num in sorted(missing)])
+
+    # the timings start with the commit, the chunks were received before
+    timer = timing.StageTimer()
+    digest = hashlib.sha1()
+    with timer.stage("receive"):
+        (fd, path) = mkstemp(suffix=upload.demofile_ext(session.filename), prefix=os.path.splitext(session.filename)[0]+"__")
+        with os.fdopen(fd, "wb") as demofile:
+            for num in range(session.num_chunks()):
+                with open(session_path(session, num), "rb") as chunk:
+                    data = chunk.read()
+                digest.update(data)
+                demofile.write(data)
+    shutil.rmtree(session_path(session), ignore_errors=True)
+
+    if digest.hexdigest() != sha1.lower():
+        logger.info("Upload session %s: SHA1 mismatch", token)
+        os.remove(path)
+        remove_session(session)
+        return "9 SHA1 of the received file does not match, please upload it again"
+
+    try:
+        with timer.stage("parse"):
+            demofile = demofile_cache.DemofileCache().parse(path, digest=digest.hexdigest())
+    except Exception, e:
+        logger.info("Upload session %s: %s", token, e)
+        os.remove(path)
+        result = "5 uploaded file is not a spring demofile"
+    else:
+        result = upload.store_upload(demofile, path, session.size, session.filename, session.subject, session.comment, session.tags, session.owner, timer)
+    UploadSession.objects.filter(pk=session.pk).update(status=UploadSession.DONE, result=result, updated=timezone.now())
+    return result
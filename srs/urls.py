@@ -7,6 +7,7 @@ admin.autodiscover()
 urlpatterns = patterns('',
     url(r'^$', 'srs.views.index'),
     url(r'^upload/$', 'srs.upload.upload'),
+    url(r'^upload_stream/$', 'srs.upload.stream_upload'),
     url(r'^search/$', 'srs.views.search'),
     url(r'^settings/$', 'srs.views.user_settings'),
     url(r'^login/$', 'srs.views.login'),
@@ -14,7 +15,9 @@ urlpatterns = patterns('',
     url(r'^all_comments/', 'srs.views.all_comments'),
     url(r'^comments/', include('django.contrib.comments.urls')),
     url(r'^download/(?P<gameID>[0-9,a-f]+)/$', 'srs.views.download'),
+    url(r'^admin/ingest_stats/$', 'srs.views.ingest_stats'),
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^ingest_stats.json$', 'srs.views.ingest_stats_json'),
     url(r'^feeds/latest_comments/$', LatestCommentFeed()),
     url(r'^xmlrpc/$', 'django_xmlrpc.views.handle_xmlrpc', name='xmlrpc'),
 
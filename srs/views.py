@@ -6,16 +6,21 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
 from django.shortcuts import render_to_response
 from django.core.context_processors import csrf
 from django.template import RequestContext
-from django.db.models import Count
+from django.db.models import Count, F
+from django.db import connection
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 import django.contrib.auth
 from django.contrib.auth.forms import AuthenticationForm
-from django.db.models import Q
 from django.http import Http404
+from django.core.servers.basehttp import FileWrapper
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.urlresolvers import reverse
 from django.contrib.comments import Comment
 from django_tables2 import RequestConfig
 
@@ -23,16 +28,25 @@ from tempfile import mkstemp
 import os
 import sets
 import shutil
+import gzip
+import json
 import functools
 import locale
 import logging
 import operator
+import base64
+import urllib
 
 from models import *
 from common import all_page_infos
 from forms import EditReplayForm
 from tables import *
 from upload import save_tags, set_autotag, save_desc
+import storage
+import timing
+import replay_pages
+import search as replay_search
+from parse_demo_file import GZIP_MAGIC
 
 logger = logging.getLogger(__package__)
 
@@ -47,9 +61,26 @@ def replays(request):
     replays = Replay.objects.all()
     return replay_table(request, replays, "all replays")
 
+def annotate_comment_count(replays):
+    """
+    adds num_comments to the replays queryset as a subquery, Comments are
+    generic relations (object_pk is text), so Count() can't be used
+    """
+    qn = connection.ops.quote_name
+    comment_table = qn(Comment._meta.db_table)
+    replay_pk = "%s.%s" % (qn(Replay._meta.db_table), qn(Replay._meta.pk.column))
+    sql = "SELECT COUNT(*) FROM %s WHERE %s.%s = %%s AND %s.%s = CAST(%s AS %s)" % (comment_table,
+        comment_table, qn(Comment._meta.get_field("content_type").column),
+        comment_table, qn(Comment._meta.get_field("object_pk").column),
+        replay_pk, "CHAR" if connection.vendor == "mysql" else "TEXT")
+    return replays.extra(select={"num_comments": sql}, select_params=[ContentType.objects.get_for_model(Replay).pk])
+
 def replay_table(request, replays, title):
+    """
+    replays: Replay queryset, all columns are fetched with it
+    """
     c = all_page_infos(request)
-    table = ReplayTable(replays)
+    table = ReplayTable(annotate_comment_count(replays.select_related("uploader", "replayfile")))
     RequestConfig(request, paginate={"per_page": 50}).configure(table)
     c['table'] = table
     c['pagetitle'] = title
@@ -59,17 +90,19 @@ def replay_table(request, replays, title):
 def replay(request, gameID):
     c = all_page_infos(request)
     try:
-        c["replay"] = Replay.objects.prefetch_related().get(gameID=gameID)
-    except:
+        c["replay"] = Replay.objects.select_related("uploader", "map_info", "map_img", "replayfile").get(gameID=gameID)
+    except Replay.DoesNotExist:
         raise Http404
 
-    c["allyteams"] = []
-    for at in Allyteam.objects.filter(replay=c["replay"]):
-        teams = Team.objects.prefetch_related("teamleader").filter(allyteam=at, replay=c["replay"])
-        if teams:
-            c["allyteams"].append((at, teams))
-    c["specs"] = Player.objects.filter(replay=c["replay"], spectator=True)
-
+    try:
+        job = IngestJob.objects.get(replay=c["replay"])
+        if job.status != IngestJob.DONE:
+            c["ingest_job"] = job
+    except IngestJob.DoesNotExist:
+        pass
+
+    # the map is still missing while the replay is being processed
+    c["fragments"] = replay_pages.get_fragments(c["replay"], cache="ingest_job" not in c)
     return render_to_response('replay.html', c, context_instance=RequestContext(request))
 
 @login_required
@@ -96,6 +129,8 @@ def edit_replay(request, gameID):
             save_tags(replay, tags)
             save_desc(replay, short, long_text, autotag)
             replay.save()
+            replay_search.index_replay(replay)
+            replay_pages.invalidate(replay.gameID)
             logger.info("User '%s' modified replay '%s': short: '%s' title:'%s' long_text:'%s' tags:'%s'",
                         request.user, replay.gameID, replay.short_text, replay.title, replay.long_text, reduce(lambda x,y: x+", "+y, [t.name for t in Tag.objects.filter(replay=replay)]))
             return HttpResponseRedirect(replay.get_absolute_url())
@@ -111,13 +146,36 @@ def download(request, gameID):
     except:
         raise Http404
 
-    rf.download_count += 1
-    rf.save()
-    return HttpResponseRedirect(settings.STATIC_URL+"replays/"+rf.filename)
+    replay_storage = storage.ReplayStorage(rf.path)
+    try:
+        demofile = replay_storage.open(rf.filename)
+    except IOError, e:
+        logger.error("ReplayFile pk=%d: %s", rf.pk, e)
+        raise Http404
+    ReplayFile.objects.filter(pk=rf.pk).update(download_count=F("download_count")+1)
+
+    # gzip'd (.sdfz) files are sent as they are if the client asks for .sdfz
+    # or it was uploaded as such, with "Content-Encoding: gzip" if the client
+    # inflates it itself and else inflated while sending
+    gzipped = demofile.read(2) == GZIP_MAGIC
+    demofile.seek(0)
+    as_sdfz = gzipped and ("sdfz" in request.GET or rf.ori_filename.lower().endswith(".sdfz"))
+    encoded = gzipped and not as_sdfz and "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+    if gzipped and not as_sdfz and not encoded:
+        response = HttpResponse(FileWrapper(gzip.GzipFile(fileobj=demofile)), content_type="application/octet-stream")
+    else:
+        response = HttpResponse(FileWrapper(demofile), content_type="application/octet-stream")
+        response["Content-Length"] = os.fstat(demofile.fileno()).st_size
+        if encoded:
+            response["Content-Encoding"] = "gzip"
+    name = os.path.splitext(os.path.basename(rf.ori_filename))[0].replace('"', '')
+    response["Content-Disposition"] = 'attachment; filename="%s%s"' % (name, ".sdfz" if as_sdfz else ".sdf")
+    response["Vary"] = "Accept-Encoding"
+    return response
 
 def tags(request):
     c = all_page_infos(request)
-    table = TagTable(Tag.objects.all())
+    table = TagTable(Tag.objects.annotate(num_replays=Count("replay")))
     RequestConfig(request, paginate={"per_page": 50}).configure(table)
     c['table'] = table
     c['pagetitle'] = "tags"
@@ -129,7 +187,7 @@ def tag(request, reqtag):
 
 def maps(request):
     c = all_page_infos(request)
-    table = MapTable(Map.objects.all())
+    table = MapTable(Map.objects.annotate(num_replays=Count("replay")))
     RequestConfig(request, paginate={"per_page": 50}).configure(table)
     c['table'] = table
     c['pagetitle'] = "maps"
@@ -141,14 +199,8 @@ def rmap(request, mapname):
 
 def players(request):
     c = all_page_infos(request)
-    players = []
-    for pa in PlayerAccount.objects.all():
-        for name in pa.names.split(";"):
-            players.append({'name': name,
-                            'replay_count': pa.replay_count(),
-                            'spectator_count': pa.spectator_count(),
-                            'accid': pa.accountid})
-    table = PlayerTable(players)
+    # one row per alias, sorted and paginated by the DB
+    table = PlayerTable(PlayerAlias.objects.select_related("account"))
     RequestConfig(request, paginate={"per_page": 50}).configure(table)
     c['table'] = table
     c['pagetitle'] = "players"
@@ -168,16 +220,12 @@ def player(request, accountid):
         for a in account.names.split(";"):
             rep += '%s '%a
 
-    players = Player.objects.select_related("replay").filter(account__in=accounts, spectator=False)
-    replays = [player.replay for player in players]
+    replays = Replay.objects.filter(player__account__in=accounts, player__spectator=False).distinct()
     return replay_table(request, replays, "replays with player %s"%rep)
 
 def games(request):
     c = all_page_infos(request)
-    games = []
-    for gt in list(set(Replay.objects.values_list('gametype', flat=True))):
-        games.append({'name': gt,
-                      'replays': Replay.objects.filter(gametype=gt).count()})
+    games = [{'name': gt, 'replays': num} for gt, num in Replay.objects.values_list('gametype').annotate(Count('pk')).order_by()]
     table = GameTable(games)
     RequestConfig(request, paginate={"per_page": 50}).configure(table)
     c['table'] = table
@@ -189,28 +237,22 @@ def game(request, gametype):
     return replay_table(request, replays, "replays of game '%s'"%gametype)
 
 def search(request):
-    # TODO
-    c = all_page_infos(request)
-    resp = "<b>TODO</b><br/><br/>"
     if request.method == 'POST':
-        st = request.POST["search"].strip()
-        if st:
-            users = User.objects.filter(username__icontains=st)
-            replays = Replay.objects.filter(Q(gametype__icontains=st)|
-                                            Q(title__icontains=st)|
-                                            Q(short_text__icontains=st)|
-                                            Q(long_text__icontains=st)|
-                                            Q(map_info__name__icontains=st)|
-                                            Q(tags__name__icontains=st)|
-                                            Q(uploader__in=users)|
-                                            Q(player__account__names__icontains=st)).distinct()
-
-            resp += 'Your search for "%s" yielded %d results:<br/><br/>'%(st, replays.count())
-            for replay in replays:
-                resp += '* <a href="%s">%s</a><br/>'%(replay.get_absolute_url(), replay.__unicode__())
-        else:
-            HttpResponseRedirect("/search/")
-    return HttpResponse(resp)
+        # the search box of all pages, redirect to a linkable / pageable URL
+        return HttpResponseRedirect("%s?%s" % (reverse(search), urllib.urlencode({"q": request.POST.get("search", "").strip().encode("utf-8")})))
+    c = all_page_infos(request)
+    query = request.GET.get("q", "").strip()
+    paginator = Paginator(replay_search.SearchResults(query), 50)
+    try:
+        page = paginator.page(request.GET.get("page", 1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+    c["query"] = query
+    c["page"] = page
+    c["pagetitle"] = "search"
+    return render_to_response('search.html', c, context_instance=RequestContext(request))
 
 @login_required
 def user_settings(request):
@@ -220,7 +262,7 @@ def user_settings(request):
 
 def users(request):
     c = all_page_infos(request)
-    table = UserTable(User.objects.all())
+    table = UserTable(User.objects.annotate(num_uploads=Count("replay")))
     RequestConfig(request, paginate={"per_page": 50}).configure(table)
     c['table'] = table
     c['pagetitle'] = "users"
@@ -278,3 +320,46 @@ def logout(request):
     django.contrib.auth.logout(request)
     logger.info("Logged out user '%s'", username)
     return HttpResponseRedirect("/")
+
+def stats_hours(request):
+    """
+    time span of the ingestion statistics from ?hours=..
+    """
+    try:
+        return float(request.GET.get("hours", settings.INGEST_TIMING_HOURS))
+    except ValueError:
+        return settings.INGEST_TIMING_HOURS
+
+@staff_member_required
+def ingest_stats(request):
+    hours = stats_hours(request)
+    c = {"stats": timing.stats(hours), "hours": hours, "percentiles": ["p%d" % pct for pct in timing.PERCENTILES],
+         "buckets": ["<= %gs" % bucket for bucket in timing.BUCKETS]+["> %gs" % timing.BUCKETS[-1]], "title": "Ingestion timings"}
+    for stage in c["stats"]:
+        stage["percentile_values"] = [stage[pct] for pct in c["percentiles"]]
+    return render_to_response('ingest_stats.html', c, context_instance=RequestContext(request))
+
+def is_staff_request(request):
+    """
+    staff user logged in, or credentials of a staff account as HTTP basic
+    auth (for monitoring)
+    """
+    if request.user.is_staff:
+        return True
+    try:
+        (username, password) = base64.b64decode(request.META["HTTP_AUTHORIZATION"].split(" ", 1)[1]).split(":", 1)
+    except Exception:
+        return False
+    user = django.contrib.auth.authenticate(username=username, password=password)
+    return user is not None and user.is_active and user.is_staff
+
+def ingest_stats_json(request):
+    """
+    timing.stats() for monitoring, ?hours=.. selects the time span
+    only for staff, like /admin/ingest_stats/
+    """
+    if not is_staff_request(request):
+        return HttpResponseForbidden("staff only", mimetype="text/plain")
+    hours = stats_hours(request)
+    result = {"hours": hours, "buckets": timing.BUCKETS, "stages": timing.stats(hours)}
+    return HttpResponse(json.dumps(result), mimetype="application/json")
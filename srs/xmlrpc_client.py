@@ -12,19 +12,132 @@
 # example cmdline call:
 # XMLRPC_USER=spads1 XMLRPC_PASSWORD=SeCr3t ./xmlrpc_client.py "awesome game" "checkout that dude in SE" tag1,tag2,tag3 20130229_123456_RustyDelta_v2_88.sdf Danchan
 #
+# with --stream the file is sent as the raw body of a chunked HTTP POST while
+# it is read, instead of base64 encoded in memory inside an XML-RPC call
+#
+# with --resumable the file is sent in chunks in an upload session, chunks
+# lost to connection problems are sent again with increasing delays
+#
 
 import os
 import sys
+import time
+import socket
+import urllib
+import hashlib
 import xmlrpclib
 import argparse
+from cStringIO import StringIO
 import pyCURLTransport
 import pycurl
 
+def stream_upload(url, user, password, path, params, throttle):
+    """
+    POST the open file path as the chunked body of a request to url,
+    returns the servers result string
+    """
+    buf = StringIO()
+    curl = pycurl.Curl()
+    curl.setopt(pycurl.NOSIGNAL, 1)
+    curl.setopt(pycurl.URL, url+"?"+urllib.urlencode(params))
+    curl.setopt(pycurl.USERPWD, "%s:%s" % (user, password))
+    curl.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
+    curl.setopt(pycurl.POST, 1)
+    curl.setopt(pycurl.HTTPHEADER, ["Content-Type: application/octet-stream", "Transfer-Encoding: chunked"])
+    curl.setopt(pycurl.READFUNCTION, path.read)
+    curl.setopt(pycurl.WRITEFUNCTION, buf.write)
+    if throttle > 0:
+        curl.setopt(pycurl.MAX_SEND_SPEED_LARGE, throttle)
+    try:
+        curl.perform()
+        httpcode = curl.getinfo(pycurl.HTTP_CODE)
+    finally:
+        curl.close()
+    if httpcode != 200:
+        return "4 server returned HTTP %d" % httpcode
+    return buf.getvalue()
+
+RETRIES = 8
+MAX_DELAY = 300 # seconds
+CONNECTION_ERRORS = (pycurl.error, socket.error, xmlrpclib.ProtocolError)
+
+def backoff(attempt):
+    """
+    seconds to wait before retry number attempt: 2, 4, 8.. MAX_DELAY
+    """
+    return min(2**(attempt+1), MAX_DELAY)
+
+def retry(func, *args):
+    """
+    call func until it doesn't raise a connection error, gives up after
+    RETRIES attempts
+    """
+    for attempt in range(RETRIES):
+        try:
+            return func(*args)
+        except CONNECTION_ERRORS, e:
+            if attempt == RETRIES-1:
+                raise
+            print >> sys.stderr, "%s, retrying in %d s." % (e, backoff(attempt))
+            time.sleep(backoff(attempt))
+
+def resumable_upload(rpc_srv, user, password, path, args):
+    """
+    send the open file path in chunks of args.chunk_size in an upload
+    session, returns the servers result string
+    """
+    path.seek(0, os.SEEK_END)
+    size = path.tell()
+    sha1 = hashlib.sha1()
+    path.seek(0)
+    for chunk in iter(lambda: path.read(1024*1024), ""):
+        sha1.update(chunk)
+
+    result = retry(rpc_srv.xmlrpc_upload_begin, user, password, os.path.basename(path.name), size, args.chunk_size, args.title, args.comment, args.tags, args.owner)
+    if result[0] != "0":
+        return result
+    token = result[2:]
+    num_chunks = max((size+args.chunk_size-1)/args.chunk_size, 1)
+    missing = range(num_chunks)
+    for attempt in range(RETRIES):
+        for num in missing:
+            path.seek(num*args.chunk_size)
+            try:
+                result = rpc_srv.xmlrpc_upload_chunk(token, num, xmlrpclib.Binary(path.read(args.chunk_size)))
+            except CONNECTION_ERRORS, e:
+                # the server is asked what is missing after this round
+                print >> sys.stderr, "chunk %d: %s" % (num, e)
+                continue
+            if result[0] != "0":
+                return result
+            if args.verbose:
+                print "sent chunk %d/%d" % (num+1, num_chunks)
+        result = retry(rpc_srv.xmlrpc_upload_status, token)
+        if result[0] != "0":
+            return result
+        received = set(int(num) for num in result[2:].split(",") if num)
+        missing = [num for num in range(num_chunks) if num not in received]
+        if not missing:
+            # a commit whose answer got lost is still running on the server
+            for attempt in range(RETRIES):
+                result = retry(rpc_srv.xmlrpc_upload_commit, token, sha1.hexdigest())
+                if result[0] != "8":
+                    break
+                time.sleep(backoff(attempt))
+            return result
+        print >> sys.stderr, "%d chunks missing, resending them in %d s." % (len(missing), backoff(attempt))
+        time.sleep(backoff(attempt))
+    return "6 could not send chunks %s" % ",".join([str(num) for num in missing])
+
 def main(argv=None):
     XMLRPC_URL = "http://replays.admin-box.com/xmlrpc/"
+    STREAM_URL = "http://replays.admin-box.com/upload_stream/"
 
-    parser = argparse.ArgumentParser(description="Upload a spring demo file to the replays site.", epilog="Please set XMLRPC_USER and XMLRPC_PASSWORD in your OS environment to a lobby accounts credentials. In case it changes, XMLRPC_URL can also be set in your environment.")
+    parser = argparse.ArgumentParser(description="Upload a spring demo file to the replays site.", epilog="Please set XMLRPC_USER and XMLRPC_PASSWORD in your OS environment to a lobby accounts credentials. In case it changes, XMLRPC_URL (STREAM_URL for --stream) can also be set in your environment.")
     parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
+    parser.add_argument("-s", "--stream", help="stream the file in a HTTP POST instead of sending it in an XML-RPC call", action="store_true")
+    parser.add_argument("-r", "--resumable", help="send the file in chunks, resending lost ones", action="store_true")
+    parser.add_argument("-c", "--chunk-size", help="chunk size in bytes for --resumable (default: 262144)", type=int, default=256*1024)
     parser.add_argument("-t", "--throttle", help="throttle upload to x byte/s, 0 means no throttling", type=int)
     parser.add_argument("title", help="short description (50 char max)")
     parser.add_argument("comment", help="long description (512 char max)")
@@ -44,6 +157,8 @@ def main(argv=None):
 
     if os.environ.has_key("XMLRPC_URL"):
         XMLRPC_URL = os.environ["XMLRPC_URL"]
+    if os.environ.has_key("STREAM_URL"):
+        STREAM_URL = os.environ["STREAM_URL"]
 
     if args.verbose:
         if args.throttle > 0:
@@ -52,13 +167,25 @@ def main(argv=None):
             sp = "without upload throttling"
         print "Uploading file '%s' for owner '%s' with subject '%s', comment '%s' and tags '%s' %s."%(args.path.name, args.owner, args.title, args.comment, args.tags, sp)
 
-    demofile = xmlrpclib.Binary(args.path.read())
+    if args.stream:
+        params = {"filename": os.path.basename(args.path.name), "subject": args.title, "comment": args.comment, "tags": args.tags, "owner": args.owner}
+        result = stream_upload(STREAM_URL, XMLRPC_USER, XMLRPC_PASSWORD, args.path, params, args.throttle)
+        if args.verbose:
+            print "%s" % result
+        return int(result[0])
 
     curltrans = pyCURLTransport.PyCURLTransport()
     if args.throttle > 0:
         curltrans._curl.setopt(pycurl.MAX_SEND_SPEED_LARGE, args.throttle)
 
     rpc_srv = xmlrpclib.ServerProxy(XMLRPC_URL, transport=curltrans)
+    if args.resumable:
+        result = resumable_upload(rpc_srv, XMLRPC_USER, XMLRPC_PASSWORD, args.path, args)
+        if args.verbose:
+            print "%s" % result
+        return int(result[0])
+
+    demofile = xmlrpclib.Binary(args.path.read())
     result = rpc_srv.xmlrpc_upload(XMLRPC_USER, XMLRPC_PASSWORD, os.path.basename(args.path.name), demofile, args.title, args.comment, args.tags, args.owner)
 
     if args.verbose: